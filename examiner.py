@@ -5,10 +5,20 @@ Examines the data - "simple"
 import pandas as pd
 import os
 import readline
+
+from processing.trade_matrix_io import read_trade_matrix
 pd.options.display.float_format = "{:,.4g}".format
 results_location = "results"
 
 
+def _trade_matrix_file(stem):
+    """The trade matrix as CSV, or in whichever other format it was written"""
+    for fmt in ["csv", "parquet", "arrow"]:
+        if os.path.exists(f"{stem}.{fmt}"):
+            return f"{stem}.{fmt}"
+    return f"{stem}.csv"
+
+
 def main():
     os.system('cls' if os.name == 'nt' else 'clear')
 
@@ -40,10 +50,10 @@ Data Type: """))
     files = []
     names = []
     if data_type == 1:
-        files = [f"{results_location}/{year}/.mrio/TradeMatrix_import_dry_matter.csv" for year in years_list]
+        files = [_trade_matrix_file(f"{results_location}/{year}/.mrio/TradeMatrix_import_dry_matter") for year in years_list]
         names = [f"TradeMatrix {year}" for year in years_list]
     elif data_type == 2:
-        files = [f"{results_location}/{year}/.mrio/TradeMatrixFeed_import_dry_matter.csv" for year in years_list]
+        files = [_trade_matrix_file(f"{results_location}/{year}/.mrio/TradeMatrixFeed_import_dry_matter") for year in years_list]
         names = [f"TradeMatrixFeed {year}" for year in years_list]
 
     else:
@@ -88,7 +98,7 @@ Data Type: """))
         return
     dataframes = []
     for file in files:
-        df = pd.read_csv(file)
+        df = pd.read_csv(file) if file.endswith(".csv") else read_trade_matrix(file)
         if "Unnamed: 0" in df.columns and df["Unnamed: 0"].dtype == int:
             df = df.drop(columns=["Unnamed: 0"])
         dataframes.append(df)
@@ -168,7 +178,7 @@ Data Type: """))
             columns = []
             filters = []
             for file in files:
-                df = pd.read_csv(file)
+                df = pd.read_csv(file) if file.endswith(".csv") else read_trade_matrix(file)
                 if "Unnamed: 0" in df.columns and df["Unnamed: 0"].dtype == int:
                     df = df.drop(columns=["Unnamed: 0"])
                 dataframes.append(df)
@@ -17,21 +17,27 @@ Added multiprocessing (country-level parallelism), October/December 2025 by Thom
 """
 
 import os
+import sys
 from pathlib import Path
 import time
 
 import multiprocessing
 
 from processing.unzip_data import unzip_data
-from processing.calculate_trade_matrix import calculate_trade_matrix
-from processing.animal_products_to_feed import animal_products_to_feed
+from processing.ingest_data import ingest_data
+from processing.calculate_trade_matrix import calculate_trade_matrix_variants, trade_matrix_inputs, trade_matrix_sources, affected_primary_items
+from processing.animal_products_to_feed import animal_products_to_feed, animal_products_to_feed_inputs, animal_products_to_feed_sources
+from processing.feed_panel import build_feed_panel
+from processing.fao_diff import year_slices, changed_items
+from processing.manifest import Manifest
+from processing.trade_matrix_io import trade_matrix_path
 
 from provenance._get_biodiversity_vals import fetch_biodiversity_vals_path
 from provenance._provenance import main as consumption_provenance_main
 from provenance._get_impacts_bd import get_impacts as get_impacts_main
 from provenance._process_dat import main as process_dat_main
 
-from pandas import read_excel, read_csv
+from processing.reference_cache import read_excel_cached
 
 # CONFIG
 RESULTS_DIR = "./results"
@@ -44,22 +50,55 @@ CONVERSION_OPTION = "dry_matter"
 # Prefer import or export data
 PREFER_IMPORT = "import"
 
+# Additional (prefer_import, conversion_option) trade matrices to calculate alongside the one above,
+# e.g. [("export", "dry_matter"), ("import", "Protein"), ("import", "Energy")]. The variants share the
+# loading and reconciliation of the trade data; the feed and country stages use the main variant
+TRADE_MATRIX_VARIANTS = []
+
+# Write the trade matrices (TradeMatrix and TradeMatrixFeed) as "csv", as typed "parquet", or as
+# a memory-mapped "arrow" store indexed by consumer and producer. Both are much faster to read back
+# in the feed and country stages, and the store lets each country read only the rows it needs
+TRADE_MATRIX_FORMAT = "csv"
+
 # select working directory
 WORKING_DIR = '.'
 
 N_PROCESSES = 8
 
+# Monte Carlo uncertainty of the trade matrices: None, or the settings of an ensemble whose
+# percentile bands are written to .mrio/Ensemble_*.parquet, e.g.
+# {"draws": 200, "error_model": {"trade": 0.1, "production": 0.05}, "percentiles": [5, 50, 95]}
+ENSEMBLE = None
+
+# Backend of the per-item MRIO solves: "auto", "dense", "sparse" or "blocks" (see processing/mrio_solvers.py).
+# "auto" picks blocks only for systems of at least 400 countries, which FAO items never reach, so
+# blocks are only used for them when set here
+MRIO_SOLVER = "auto"
+
+# Size limit in bytes of the cache of per-item MRIO solutions in RESULTS_DIR/.cache/mrio, keyed by each
+# item's trade matrix, production and solver settings, so rerunning the trade stage only solves the
+# items whose inputs changed. None disables the cache
+MRIO_CACHE_SIZE = 2 << 30
+
+# Also extract the FAOSTAT archives into input_data. Not needed by the pipeline, which
+# streams the data straight out of the zip files into the columnar cache
+EXTRACT_ARCHIVES = False
+
+# Skip stages for years whose results were built from unchanged inputs. After a FAOSTAT
+# revision only the years (and, for the trade matrix, the items) whose data changed are recomputed
+SKIP_UP_TO_DATE = True
+
 # Pipeline components to run
-# 0 = all, 1 = unzip, 2 = trade matrix, 3 = animal products to feed, 4 = country impacts
+# 0 = all, 1 = unzip and ingest, 2 = trade matrix, 3 = animal products to feed, 4 = country impacts
 PIPELINE_COMPONENTS: list = [0]
 
-cdat = read_excel("input_data/nocsDataExport_20251021-164754.xlsx")
+cdat = read_excel_cached("input_data/nocsDataExport_20251021-164754.xlsx")
 COUNTRIES = [_.upper() for _ in cdat["ISO3"].unique().tolist() if isinstance(_, str)]
 COUNTRIES = ["USA", "IND", "BRA", "JPN", "UGA", "GBR"]
 
 
 
-def _process_country(country: str, year: int, hist: str):
+def _process_country(country: str, year: int, hist: str, trade_matrix_format="csv"):
     """
     Uses the globally-initialized _SUA and _HIST values.
     """
@@ -68,7 +107,7 @@ def _process_country(country: str, year: int, hist: str):
         print(f"    [PID {os.getpid()}] Processing country: {country}")
         t0 = time.perf_counter()
         # consumption_provenance_main returns (cons, feed) per original script
-        cons, feed = consumption_provenance_main(year, country, hist, results_dir=Path(RESULTS_DIR))
+        cons, feed = consumption_provenance_main(year, country, hist, results_dir=Path(RESULTS_DIR), trade_matrix_format=trade_matrix_format)
         if len(cons) == 0:
             print(f"    [PID {os.getpid()}] No consumption data for {country} in {year}")
             return []  # nothing to do for this country
@@ -80,9 +119,78 @@ def _process_country(country: str, year: int, hist: str):
         print(f"    [PID {os.getpid()}] Completed {country} in {t1 - t0:.2f} seconds")
         return missing_items_local
     except Exception as e:
-        # Print error and continue; return empty list so caller can continue aggregating
+        # Print error and continue; return None so the caller knows the country failed
         print(f"    [PID {os.getpid()}] Error processing {country} for {year}: {e}")
-        return []
+        return None
+
+
+def _country_stage_inputs(year, bd_path, results_dir, trade_matrix_format="csv"):
+    """
+    Files the country-level provenance and impacts are built from
+    (FAOSTAT production is tracked by its (Year, Item_Code) slices instead)
+    """
+    mrio_dir = results_dir / str(year) / ".mrio"
+    dat_path = Path("./input_data")
+    return [
+        # the provenance stage reads the import/dry_matter trade matrices
+        trade_matrix_path(results_dir, year, "TradeMatrix", fmt=trade_matrix_format),
+        trade_matrix_path(results_dir, year, "TradeMatrixFeed", fmt=trade_matrix_format),
+        mrio_dir / "Pasture_calc.csv",
+        Path(bd_path),
+        dat_path / "nocsDataExport_20251021-164754.xlsx",
+        dat_path / "SUA_Crops_Livestock_E_ItemCodes.csv",
+        dat_path / "weighing_factors.csv",
+        dat_path / "commodity_crosswalk.csv",
+        dat_path / "schwarzmueller_wwf.csv",
+        dat_path / "Planet-Based Diets - Data and Viewer.xlsx",
+        dat_path / "composition_old_vs_new.csv",
+        *[Path(sys.modules[f.__module__].__file__) for f in (consumption_provenance_main, get_impacts_main, process_dat_main)],
+    ]
+
+
+def _trade_stage(years, conversion_option, prefer_import, results_dir, results_manifest, skip_up_to_date, n_processes, trade_matrix_format="csv", ensemble=None, variants=(), mrio_cache_size=None, solver="auto"):
+    """
+    Trade matrices of all years and variants that are not up to date. The years are calculated in
+    batches (historic and current balance sheets) so the sources are read and harmonised once, and
+    the additional (prefer_import, conversion_option) variants share that preprocessing
+    """
+    # ensemble runs are recorded with their settings, so changing them recomputes the trade matrices
+    trade_params = {"ensemble": ensemble} if ensemble else None
+    variants = list(dict.fromkeys([(prefer_import, conversion_option), *map(tuple, variants)]))
+    pending = {}
+    for year in years:
+        hist = "Historic" if year < 2010 else ""
+        trade_inputs = trade_matrix_inputs(hist)
+        trade_slices = year_slices(trade_matrix_sources(hist), year)
+        for variant in variants:
+            label = f"{year}" if len(variants) == 1 else f"{year} ({variant[0]}, {variant[1]})"
+            trade_output = trade_matrix_path(results_dir, year, "TradeMatrix", *variant, trade_matrix_format)
+            if skip_up_to_date and results_manifest.is_current(trade_output, trade_inputs, trade_params, trade_slices):
+                print(f"    {label}: trade matrix up to date, skipping")
+                continue
+            items = None
+            if skip_up_to_date and results_manifest.stale_inputs(trade_output, trade_inputs, trade_params) == []:
+                # only FAOSTAT data changed: recompute just the items that depend on it
+                changes = changed_items(results_manifest.recorded_slices(trade_output), trade_slices)
+                items = affected_primary_items(changes, hist)
+                print(f"    {label}: FAOSTAT changes affect {len(items)} trade matrix items")
+            pending.setdefault(hist, {}).setdefault(variant, {})[year] = (trade_output, trade_inputs, trade_slices, items)
+
+    for hist, batch in pending.items():
+        print(f"    Calculating trade matrices for {sorted({year for variant_years in batch.values() for year in variant_years})}")
+        calculate_trade_matrix_variants(
+            {variant: {year: items for year, (_, _, _, items) in variant_years.items()} for variant, variant_years in batch.items()},
+            historic=hist,
+            results_dir=results_dir,
+            solver=solver,
+            n_workers=n_processes,
+            trade_matrix_format=trade_matrix_format,
+            ensemble=ensemble,
+            cache_size=mrio_cache_size)
+        for variant_years in batch.values():
+            for trade_output, trade_inputs, trade_slices, _ in variant_years.values():
+                results_manifest.record_artifact(trade_output, trade_inputs, trade_params, trade_slices)
+        results_manifest.save()
 
 
 def main(years=list(range(1986, 2022)),
@@ -92,7 +200,14 @@ def main(years=list(range(1986, 2022)),
          working_dir=".",
          countries=None,
          results_dir="./results",
-         n_processes=None):
+         n_processes=None,
+         extract_archives=False,
+         skip_up_to_date=True,
+         trade_matrix_format="csv",
+         ensemble=None,
+         trade_matrix_variants=(),
+         mrio_cache_size=None,
+         mrio_solver="auto"):
 
     if countries is None:
         countries = COUNTRIES
@@ -102,7 +217,7 @@ def main(years=list(range(1986, 2022)),
 
     component_dict = {
         0: "Full pipeline",
-        1: "Unzipping data",
+        1: "Ingesting (and optionally unzipping) data",
         2: "Trade matrix calculation",
         3: "Animal products to feed calculation",
         4: "Country-level provenance calculations",
@@ -112,6 +227,7 @@ def main(years=list(range(1986, 2022)),
     Working directory: {working_dir}
     Using {conversion_option} as the conversion option
     Preferring {prefer_import} data
+    Additional trade matrix variants: {list(trade_matrix_variants) or None}
     Running pipeline component {[p for p in pipeline_components]}: {[component_dict[p] for p in pipeline_components]}
 
     Years to process: {years}
@@ -120,8 +236,10 @@ def main(years=list(range(1986, 2022)),
     # check results dir
     results_dir = Path(results_dir)
     results_dir.mkdir(exist_ok=True)
+    # content hashes of the results and the inputs each stage output was built from
+    results_manifest = Manifest(results_dir)
 
-    if (0 in pipeline_components) or (1 in pipeline_components):
+    if ((0 in pipeline_components) or (1 in pipeline_components)) and extract_archives:
         print("Unzipping data...")
         try:
             unzip_data("./input_data") 
@@ -129,6 +247,14 @@ def main(years=list(range(1986, 2022)),
         except Exception as e:
             print(f"Error during data unzipping: {e}")
 
+    if (0 in pipeline_components) or (1 in pipeline_components):
+        print("Building columnar cache of FAOSTAT data...")
+        try:
+            ingest_data("./input_data")
+            print("Columnar cache up to date.")
+        except Exception as e:
+            print(f"Error during data ingest: {e}")
+
 
     if pipeline_components == [1]:
         return
@@ -139,6 +265,15 @@ def main(years=list(range(1986, 2022)),
         except Exception:
             n_processes = 1
 
+    if (0 in pipeline_components) or (3 in pipeline_components):
+        # commodity balance feed supply for all years, sliced by the per-year feed stage
+        print("Preparing multi-year feed panel...")
+        build_feed_panel(conversion_option, "./input_data")
+
+    if (0 in pipeline_components) or (2 in pipeline_components):
+        print("Calculating trade matrices...")
+        _trade_stage(years, conversion_option, prefer_import, results_dir, results_manifest, skip_up_to_date, n_processes, trade_matrix_format, ensemble, trade_matrix_variants, mrio_cache_size, mrio_solver)
+
     for year in years:
 
         # year_dir = Path(f"./results/{year}")
@@ -155,69 +290,90 @@ def main(years=list(range(1986, 2022)),
 
         hist = "Historic" if year < 2010 else ""
 
-        if (0 in pipeline_components) or (2 in pipeline_components):
-            calculate_trade_matrix(
-                conversion_opt=conversion_option,
-                prefer_import=prefer_import,
-                year=year,
-                historic=hist,
-                results_dir=results_dir)
-
         if (0 in pipeline_components) or (3 in pipeline_components):
-            animal_products_to_feed(
-                prefer_import=prefer_import,
-                conversion_opt=conversion_option,
-                year=year,
-                historic=hist,
-                results_dir=results_dir)
+            feed_outputs = [trade_matrix_path(results_dir, year, "TradeMatrixFeed", prefer_import, conversion_option, trade_matrix_format), mrio_dir / "Pasture_calc.csv"]
+            feed_inputs = animal_products_to_feed_inputs(prefer_import, conversion_option, year, hist, results_dir, trade_matrix_format=trade_matrix_format)
+            feed_slices = year_slices(animal_products_to_feed_sources(hist), year)
+            # Pasture_calc is shared between variants, so the variant is recorded with it
+            feed_params = {"prefer_import": prefer_import, "conversion_opt": conversion_option}
+            if skip_up_to_date and all(results_manifest.is_current(f, feed_inputs, feed_params, feed_slices) for f in feed_outputs):
+                print("    Feed results up to date, skipping")
+            else:
+                animal_products_to_feed(
+                    prefer_import=prefer_import,
+                    conversion_opt=conversion_option,
+                    year=year,
+                    historic=hist,
+                    results_dir=results_dir,
+                    trade_matrix_format=trade_matrix_format)
+                for f in feed_outputs:
+                    results_manifest.record_artifact(f, feed_inputs, feed_params, feed_slices)
+                results_manifest.save()
 
         if (0 in pipeline_components) or (4 in pipeline_components):
-            print("    Processing country-level provenance and impacts...")
-            missing_items = []
-            fetch_biodiversity_vals_path(year, "./input_data")
+            bd_path, _ = fetch_biodiversity_vals_path(year, "./input_data")
+            missing_items_file = results_dir / str(year) / "missing_items.txt"
+            country_inputs = _country_stage_inputs(year, bd_path, results_dir, trade_matrix_format)
+            country_slices = year_slices(["production"], year)
+            country_params = {"countries": sorted(countries)}
+            if skip_up_to_date and results_manifest.is_current(missing_items_file, country_inputs, country_params, country_slices):
+                print("    Country-level results up to date, skipping")
+            else:
+                print("    Processing country-level provenance and impacts...")
+                missing_items = []
+                failed = []
+
+                if len(countries) <= 1 or n_processes == 1:
+
+                    for country in countries:
+                        try:
+                            print(f"    Processing country: {country}")
+                            t0 = time.perf_counter()
+                            cons, feed = consumption_provenance_main(year, country, hist, results_dir=results_dir, trade_matrix_format=trade_matrix_format)
+                            if len(cons) == 0:
+                                continue
+                            bf = get_impacts_main(feed, year, country, "feed_impacts_wErr.csv", results_dir=results_dir)
+                            bh = get_impacts_main(cons, year, country, "human_consumed_impacts_wErr.csv", results_dir=results_dir)
+                            mi = process_dat_main(year, country, bh, bf, results_dir=results_dir)
+                            missing_items.extend(mi)
+                            t1 = time.perf_counter()
+                            print(f"         Completed in {t1 - t0:.2f} seconds")
+                        except Exception as e:
+                            print(f"Error processing {country}: {e}")
+                            failed.append(country)
+
+                else:
+                    # Use a Pool of worker processes. Initialize each worker to load the SUA file once.
+                    processes = min(n_processes, len(countries))
+                    print(f"    Spawning {processes} worker processes for {len(countries)} countries")
+                    pool = multiprocessing.Pool(processes=processes)
+                    try:
+                        args_iterable = [(c, year, hist, trade_matrix_format) for c in countries]
 
-            if len(countries) <= 1 or n_processes == 1:
+                        results = pool.starmap(_process_country, args_iterable)
 
-                for country in countries:
-                    try:
-                        print(f"    Processing country: {country}")
-                        t0 = time.perf_counter()
-                        cons, feed = consumption_provenance_main(year, country, hist, results_dir=results_dir)
-                        if len(cons) == 0:
-                            continue
-                        bf = get_impacts_main(feed, year, country, "feed_impacts_wErr.csv", results_dir=results_dir)
-                        bh = get_impacts_main(cons, year, country, "human_consumed_impacts_wErr.csv", results_dir=results_dir)
-                        mi = process_dat_main(year, country, bh, bf, results_dir=results_dir)
-                        missing_items.extend(mi)
-                        t1 = time.perf_counter()
-                        print(f"         Completed in {t1 - t0:.2f} seconds")
-                    except Exception as e:
-                        print(f"Error processing {country}: {e}")
+                        for country, res in zip(countries, results):
+                            if res is None:
+                                failed.append(country)
+                            elif res:
+                                missing_items.extend(res)
+                    finally:
+                        pool.close()
+                        pool.join()
 
-            else:
-                # Use a Pool of worker processes. Initialize each worker to load the SUA file once.
-                processes = min(n_processes, len(countries))
-                print(f"    Spawning {processes} worker processes for {len(countries)} countries")
-                pool = multiprocessing.Pool(processes=processes)
-                try:
-                    args_iterable = [(c, year, hist) for c in countries]
-
-                    results = pool.starmap(_process_country, args_iterable)
-
-                    for res in results:
-                        if res:
-                            missing_items.extend(res)
-                finally:
-                    pool.close()
-                    pool.join()
+                with open(missing_items_file, "w") as f:
+                    f.write("Items missing from crosswalk and their codes:\n")
 
-            missing_items_file = results_dir / str(year) / "missing_items.txt"
+                    for item, code in set(missing_items):
+                        f.write(f" - {item}: {code}\n")
 
-            with open(missing_items_file, "w") as f:
-                f.write("Items missing from crosswalk and their codes:\n")
+                # years with failed countries are rerun next time
+                if not failed:
+                    results_manifest.record_artifact(missing_items_file, country_inputs, country_params, country_slices)
 
-                for item, code in set(missing_items):
-                    f.write(f" - {item}: {code}\n")
+        # record the hashes and sizes of everything produced for this year
+        results_manifest.scan(year_dir)
+        results_manifest.save()
 
         print(f"Year {year} processing completed successfully\n")
 
@@ -232,4 +388,11 @@ if __name__ == "__main__":
         results_dir=RESULTS_DIR,
         countries=COUNTRIES,
         n_processes=N_PROCESSES, 
+        extract_archives=EXTRACT_ARCHIVES,
+        skip_up_to_date=SKIP_UP_TO_DATE,
+        trade_matrix_format=TRADE_MATRIX_FORMAT,
+        ensemble=ENSEMBLE,
+        trade_matrix_variants=TRADE_MATRIX_VARIANTS,
+        mrio_cache_size=MRIO_CACHE_SIZE,
+        mrio_solver=MRIO_SOLVER,
     )
\ No newline at end of file
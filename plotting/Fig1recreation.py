@@ -1,6 +1,10 @@
 import pandas as pd
 import numpy as np
 import os
+import sys
+
+sys.path.append("..")
+from processing.reference_cache import read_excel_cached
 import matplotlib.pyplot as plt
 import seaborn as sns
 
@@ -130,7 +134,7 @@ df["Impact_per_kg"] = df["bd_opp_cost_calc"] / (df["TotalProduction"]*1000)
 import warnings
 with warnings.catch_warnings():
     warnings.simplefilter("ignore")
-    area_codes = pd.read_excel(f"../input_data/nocsDataExport_20251021-164754.xlsx", engine="openpyxl")  
+    area_codes = read_excel_cached(f"../input_data/nocsDataExport_20251021-164754.xlsx", engine="openpyxl")  
     area_codes = area_codes[["ISO3", "FAOSTAT"]].rename(columns={"ISO3":"Country", "FAOSTAT":"Effective_Producer_Code"})
 df = df.merge(area_codes, on="Effective_Producer_Code", how="left")
 
@@ -3,6 +3,11 @@ import pylab as plt
 import seaborn as sns
 import seaborn.objects as so
 import os
+import sys
+
+sys.path.append("..")
+from processing.ingest_data import load_fao
+from processing.reference_cache import read_excel_cached
 
 color_dict = {'Grains, roots, starchy carbohydrates' : "#E69F00",
                 'Legumes, beans, nuts' : "#F0E442",
@@ -28,11 +33,11 @@ order = pd.DataFrame({'Grains, roots, starchy carbohydrates' : 3,
 import warnings
 with warnings.catch_warnings():
     warnings.simplefilter("ignore")
-    area_codes = pd.read_excel(f"../input_data/nocsDataExport_20251021-164754.xlsx", engine="openpyxl")  
+    area_codes = read_excel_cached(f"../input_data/nocsDataExport_20251021-164754.xlsx", engine="openpyxl")  
     area_codes = area_codes[["ISO3", "FAOSTAT"]].rename(columns={"ISO3":"Country", "FAOSTAT":"FAO_Code"})
 
-pop_data = pd.read_csv("../input_data/SUA_Crops_Livestock_E_All_Data_(Normalized).csv", encoding="latin-1", low_memory=False)
-pop_data = pop_data[pop_data["Element Code"] == 511][["Area Code", "Year", "Value"]]
+pop_data = load_fao("sua", "../input_data", elements=511, columns=["Area_Code", "Element_Code", "Year", "Value"])
+pop_data = pop_data[pop_data["Element_Code"] == 511][["Area_Code", "Year", "Value"]].rename(columns={"Area_Code": "Area Code"})
 pop_data["Value"] *= 1000  # convert to individuals
 
 
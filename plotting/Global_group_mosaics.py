@@ -5,6 +5,10 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 from matplotlib.colors import LinearSegmentedColormap
 import numpy as np
+import sys
+
+sys.path.append("..")
+from processing.reference_cache import read_excel_cached
 
 
 # Figure setup
@@ -321,7 +325,7 @@ ax2.tick_params(axis='x', colors=total_grid_color)
 ax = axs[2, 0]
 ax2 = axs[2, 1]
 
-cdat = pd.read_excel("../input_data/nocsDataExport_20251021-164754.xlsx")
+cdat = read_excel_cached("../input_data/nocsDataExport_20251021-164754.xlsx")
 COUNTRIES = [_.upper() for _ in cdat["ISO3"].unique().tolist() if isinstance(_, str)]
 
 feed_df_2010 = pd.DataFrame()
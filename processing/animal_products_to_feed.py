@@ -12,6 +12,11 @@ import pandas as pd
 import numpy as np
 from pathlib import Path
 
+from processing.ingest_data import load_fao
+from processing.reference_cache import read_excel_cached
+from processing.feed_panel import feed_panel_files, load_feed_panel
+from processing.trade_matrix_io import read_trade_matrix, trade_matrix_path, write_trade_matrix
+
 def ml_animal_prod(year, country, production_animals,feed_data, weighing_factors,):
     production_animal_data_1 = production_animals[
         (production_animals["Area_Code"] == country) &
@@ -48,156 +53,63 @@ def ml_animal_prod(year, country, production_animals,feed_data, weighing_factors
                 })
     return results
 
-def animal_products_to_feed(prefer_import="import", conversion_opt="dry_matter", year=2013, historic="Historic", results_dir=Path("./results")):
+def animal_products_to_feed_sources(historic="Historic"):
+    """FAOSTAT sources animal_products_to_feed reads (directly or through the feed panel)"""
+    balance_sources = ["fbs_historic", "commodity_balances"] if historic == "Historic" else ["fbs", "sua"]
+    return ["production", "land_use", *balance_sources]
+
+def animal_products_to_feed_inputs(prefer_import="import", conversion_opt="dry_matter", year=2013, historic="Historic", results_dir=Path("./results"), path="./input_data", trade_matrix_format="csv"):
+    """
+    Other files animal_products_to_feed is built from, used to check whether existing feed results are current
+    (the FAOSTAT sources are tracked by their (Year, Item_Code) slices instead)
+    """
+    return [
+        trade_matrix_path(results_dir, year, "TradeMatrix", prefer_import, conversion_opt, trade_matrix_format),
+        *feed_panel_files(path),
+        Path(path) / "CB_items_split.csv",
+        Path(path) / "weighing_factors.csv",
+        Path(path) / "nocsDataExport_20251021-164754.xlsx",
+        Path(__file__),
+    ]
+
+def animal_products_to_feed(prefer_import="import", conversion_opt="dry_matter", year=2013, historic="Historic", results_dir=Path("./results"), trade_matrix_format="csv"):
     print("    Loading files for animal products to feed conversion...")
 
-    cb_map_filename = "input_data/CB_to_primary_items_map.csv"
     cb_split_filename = "input_data/CB_items_split.csv" 
-    content_factors_filename = "input_data/content_factors_per_100g.xlsx"
-    cb_conversion_filename = "input_data/CB_code_FAO_code_for_conversion_factors.csv"
-    animals_filename = "input_data/Production_Crops_Livestock_E_All_Data_(Normalized).csv"
     weighing_filename = "input_data/weighing_factors.csv"
 
-    trade_matrix_filename = results_dir / str(year) / ".mrio" / f"TradeMatrix_{prefer_import}_{conversion_opt}.csv"
-    output_filename = results_dir / str(year) / ".mrio" / f"TradeMatrixFeed_{prefer_import}_{conversion_opt}.csv"
+    trade_matrix_filename = trade_matrix_path(results_dir, year, "TradeMatrix", prefer_import, conversion_opt, trade_matrix_format)
+    output_filename = trade_matrix_path(results_dir, year, "TradeMatrixFeed", prefer_import, conversion_opt, trade_matrix_format)
 
     if not Path(trade_matrix_filename).exists():
         raise FileNotFoundError(f"Trade matrix file not found: {trade_matrix_filename}")
-    transformed_data = pd.read_csv(trade_matrix_filename, encoding="Latin-1")
-    cb_map = pd.read_csv(cb_map_filename, encoding="Latin-1")
+    transformed_data = read_trade_matrix(trade_matrix_filename)
     cb_split = pd.read_csv(cb_split_filename, encoding="Latin-1")
-    content_factors = pd.read_excel(content_factors_filename, skiprows=1)
-    cb_conversion_map = pd.read_csv(cb_conversion_filename, encoding="Latin-1")
-    production_animals = pd.read_csv(animals_filename, encoding="Latin-1", low_memory=False)
+    production_animals = load_fao("production", years=year, elements=5510,
+        columns=["Area_Code", "Item_Code", "Element_Code", "Year", "Value"])
     weighing_factors = pd.read_csv(weighing_filename, encoding="Latin-1")
-    units = pd.read_excel(content_factors_filename, header=None, nrows=1)
-    units.columns = content_factors.columns
 
 
-    content_factors.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-    production_animals.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
     weighing_factors.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
 
     # fix missing data from indian cattle - data from FAO: https://www.fao.org/faostat/en/#data/SCL
     indian_cattle_prod = [998071.03, 989522.18, 980561.33, 971291.48, 960991.17, 931645.26, 913009.07, 899727.75, 901236.5, 915639.94, 915639.94, 915639.94, 915639.94, 915639.94]
-    production_animals.loc[(production_animals["Item_Code"]==867)&
-                           (production_animals["Area_Code"]==100)&
-                           (production_animals["Element_Code"]==5510)&
-                           (production_animals["Year"]>=2010), "Value"] = indian_cattle_prod
+    indian_cattle_prod = dict(zip(range(2010, 2010 + len(indian_cattle_prod)), indian_cattle_prod))
+    cattle_mask = ((production_animals["Item_Code"]==867)&
+                   (production_animals["Area_Code"]==100)&
+                   (production_animals["Element_Code"]==5510)&
+                   (production_animals["Year"].isin(indian_cattle_prod)))
+    production_animals.loc[cattle_mask, "Value"] = production_animals.loc[cattle_mask, "Year"].map(indian_cattle_prod)
 
 
 
     production_animals = production_animals[(production_animals["Year"] == year) &
         (production_animals["Element_Code"] == 5510)]
 
-    
-    content_factors_cb = cb_conversion_map.merge(content_factors, 
-        left_on="FAO_code",
-        right_on="Item_Code",
-        how="left"
-        ).drop(columns=["Item", "FAO_code", "FAO_name", "Item_Code"]
-        ).rename(columns={"CB_code": "Item_Code", "CB_name": "Item"})
-    content_factors_cb = content_factors_cb[["Item_Code", conversion_opt]]
-
-    joined = cb_map.merge(
-        content_factors_cb,
-        on="Item_Code",
-        how="left")
-    joined = joined.merge(
-        content_factors_cb,
-        left_on="Primary_Item_Code",
-        right_on="Item_Code",
-        how="left",
-        suffixes=("_x", "_y")).drop(columns=["Item_Code_y"]).rename(columns={"Item_Code_x": "Item_Code"})
-
-    joined["Conversion_factor"] = joined[f"{conversion_opt}_x"] / joined[f"{conversion_opt}_y"]
-    joined = joined.sort_values(by="Primary_Item_Code")
-
-    conversion_factors = joined[joined["Conversion_factor"].notna()][["Item_Code", "Primary_Item_Code", "Conversion_factor"]]
-
-
 
     print("    Preparing commodity balance data...")
-    ################################
-    # NEW METHOD
-    if historic == "Historic":
-        cb_crops_filename=f"input_data/FoodBalanceSheetsHistoric_E_All_Data_(Normalized).csv"
-        cb_crops_data = pd.read_csv(cb_crops_filename, encoding="Latin-1")
-        cb_crops_data.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-        cb_crops_data = cb_crops_data[(cb_crops_data["Year"] == year) &
-            (cb_crops_data["Element_Code"] == 5521)]
-        cb_crops_data["Value"] = cb_crops_data["Value"]*1000
-        cb_crops_data["Unit"] = "t"
-        cb_crops_filename2=f"input_data/CommodityBalances_(non-food)_(-2013_old_methodology)_E_All_Data_(Normalized).csv"
-        cb_crops_data2 = pd.read_csv(cb_crops_filename2, encoding="Latin-1")
-        cb_crops_data2.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-        cb_crops_data2 = cb_crops_data2[(cb_crops_data2["Year"] == year) &
-            (cb_crops_data2["Element_Code"] == 5520)]
-        cb_crops_data = pd.concat([cb_crops_data, cb_crops_data2], ignore_index=True)
-        del(cb_crops_data2)
-
-    else:
-        cb_crops_filename=f"input_data/FoodBalanceSheets_E_All_Data_(Normalized).csv"
-        cb_crops_data = pd.read_csv(cb_crops_filename, encoding="Latin-1")
-        cb_crops_data.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-        cb_crops_data = cb_crops_data[(cb_crops_data["Year"] == year) &
-            (cb_crops_data["Element_Code"] == 5521)]
-        cb_crops_data["Value"] = cb_crops_data["Value"]*1000  
-
-        # remove extra data to just leave crops
-        cb_crops_data = cb_crops_data.merge(
-            cb_conversion_map[["FAO_code", "CB_code"]],
-            left_on="Item_Code",
-            right_on="CB_code",
-            how="left")
-        cb_crops_data = cb_crops_data[cb_crops_data["FAO_code"]<867]
-        cb_crops_data = cb_crops_data.drop(columns=["FAO_code", "CB_code", "Note"])
-
-        # add missing data that is no longer reported as food
-        cb_crops_filename2=f"input_data/SUA_Crops_Livestock_E_All_Data_(Normalized).csv"
-        cb_crops_data2 = pd.read_csv(cb_crops_filename2, encoding="Latin-1", low_memory=False)
-        cb_crops_data2.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-        cb_crops_data2 = cb_crops_data2[(cb_crops_data2["Year"] == year) &
-            (cb_crops_data2["Element_Code"] == 5520)]
-        
-        missing_item_codes = [17, 767, 329, 332, 780, 335, 291, 269, 826, 634, 253, 821, 256, 259, 272, 270, 836, 789, 771, 238, 782, 809]
-        cb_crops_data2 = cb_crops_data2[cb_crops_data2["Item_Code"].isin(missing_item_codes)]
-        # map FAO item codes to CB codes where available
-        cb_crops_data2 = cb_crops_data2.merge(
-            cb_conversion_map[["FAO_code", "CB_code"]],
-            left_on="Item_Code",
-            right_on="FAO_code",
-            how="left")
-        cb_crops_data2["Item_Code"] = cb_crops_data2["CB_code"].fillna(cb_crops_data2["Item_Code"])
-        cb_crops_data2.drop(columns=["FAO_code", "CB_code", "Note"], inplace=True)
-        cb_crops_data = pd.concat([cb_crops_data, cb_crops_data2], ignore_index=True)
-        del(cb_crops_data2)   
-
-
-
-    # # OLD METHOD
-    # cb_crops_filename = "input_data/deprecated/CommodityBalances_Crops_E_All_Data_(Normalized).csv" # f"input_data/FoodBalanceSheets{historic}_E_All_Data_(Normalized).csv" 
-    # cb_crops_data = pd.read_csv(cb_crops_filename, encoding="Latin-1")
-    # cb_crops_data.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-    # cb_crops_data = cb_crops_data[(cb_crops_data["Year"] == year) &
-    #     (cb_crops_data["Element_Code"] == 5520)]
-    # ###########################################
-
-   
-    cb_data = cb_crops_data.merge(
-        conversion_factors,
-        on="Item_Code",
-        how="left")
-
-    cb_data["Value_new"] = cb_data["Value"] * cb_data["Conversion_factor"]
-
-    feed_data = cb_data[(cb_data["Area_Code"]<300) & (cb_data["Primary_Item_Code"].notna())]
-    feed_data = (feed_data
-        .groupby(["Area_Code", "Year", "Primary_Item_Code"])
-        .agg({"Value_new": "sum"})
-        .reset_index()
-        .rename(columns={"Value_new": "Value"})
-        )
+    # harmonised feed supply (historic/current balance sheets, converted to primary items) for this year
+    feed_data = load_feed_panel(conversion_opt, year)
 
     unique_combinations = transformed_data[["Producer_Country_Code", "Year"]].drop_duplicates()
     unique_combinations = unique_combinations.sort_values(by=["Year", "Producer_Country_Code"])
@@ -308,7 +220,7 @@ def animal_products_to_feed(prefer_import="import", conversion_opt="dry_matter",
     # if __name__ == "__main__":
     #     output_data.to_csv(f"{output_filename[:-4]}_temp.csv", index=False)
 
-    output_data.to_csv(output_filename, index=False)
+    write_trade_matrix(output_data, output_filename)
     pasture_items = [867, 882, 947, 951, 977, 982, 1017, 1020, 1097]
     bvmeat = 25
     bvmilk = 0.7
@@ -336,10 +248,10 @@ def animal_products_to_feed(prefer_import="import", conversion_opt="dry_matter",
     productions = productions[["Item_Code", "Country_Code", "Area_Share", "Pasture_Percent_Error", "Value"]]
 
     # Pasture area calculation
-    areas = pd.read_csv("input_data/Inputs_LandUse_E_All_Data.csv", encoding="Latin-1")
-    areas = areas[(areas["Item Code"]==6655)&(areas["Element Code"]==5110)][["Area Code", f"Y{year}"]]
+    areas = load_fao("land_use", columns=["Area_Code", "Item_Code", "Element_Code", f"Y{year}"])
+    areas = areas[(areas["Item_Code"]==6655)&(areas["Element_Code"]==5110)][["Area_Code", f"Y{year}"]]
     areas[f"Y{year}"] *= 1e7  # convert from 1000 ha to m2
-    areas = areas.rename(columns={f"Y{year}":"Total_Pasture_Area_m2", "Area Code":"Country_Code"})
+    areas = areas.rename(columns={f"Y{year}":"Total_Pasture_Area_m2", "Area_Code":"Country_Code"})
 
     productions = productions.merge(areas, on="Country_Code", how="left")
     productions["Total_Pasture_Area_m2"] = productions["Total_Pasture_Area_m2"].fillna(0)
@@ -347,11 +259,8 @@ def animal_products_to_feed(prefer_import="import", conversion_opt="dry_matter",
     productions = productions[["Item_Code", "Country_Code", "Pasture_Area_m2", "Pasture_Percent_Error", "Value", "Area_Share"]]
     productions["Pasture_Efficiency_m2_per_kg"] = productions["Pasture_Area_m2"] / productions["Value"]
 
-    import warnings
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        area_codes = pd.read_excel(f"input_data/nocsDataExport_20251021-164754.xlsx", engine="openpyxl")  
-        area_codes = area_codes[["ISO3", "FAOSTAT"]].rename(columns={"ISO3":"Country_ISO", "FAOSTAT":"Country_Code"})
+    area_codes = read_excel_cached(f"input_data/nocsDataExport_20251021-164754.xlsx", engine="openpyxl")  
+    area_codes = area_codes[["ISO3", "FAOSTAT"]].rename(columns={"ISO3":"Country_ISO", "FAOSTAT":"Country_Code"})
     productions = productions.merge(area_codes, on="Country_Code", how="left")
     productions = productions.rename(columns={"Pasture_Efficiency_m2_per_kg": "fp_m2_kg", "Pasture_Percent_Error": "fp_m2_kg_perc", "Area_Share": "g_rat"})
     productions = productions[["Item_Code", "Country_ISO", "fp_m2_kg", "fp_m2_kg_perc", "g_rat"]]
@@ -8,128 +8,282 @@ Please cite ;-)
 Re-written in Python, October 2025 by Louis De Neve
 """
 
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 from pathlib import Path
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
-from numba import jit
 import warnings
+
+from processing.ingest_data import load_fao
+from processing.reference_cache import read_excel_cached
+from processing.mrio_cache import CACHE_SUBDIR as MRIO_CACHE_SUBDIR, MrioCache
+from processing.mrio_solvers import ENSEMBLE_DRAWS, ENSEMBLE_PERCENTILES, ensemble_bands, solve_mrio
+from processing.trade_matrix_io import trade_matrix_path, write_trade_matrix
 warnings.filterwarnings("ignore", category=FutureWarning)
 np.seterr(divide="ignore")
 
-def eliminate_dates(reporting_dates:pd.DataFrame, function_dataframe:pd.DataFrame) -> pd.DataFrame:
-    # removes countries that were not correctly reported
-    
-    reporting_dates_start = reporting_dates[["Country_Code", "Start_Year"]].dropna()
-    reporting_dates_end = reporting_dates[["Country_Code", "End_Year"]].dropna()
-
-    for country, year in reporting_dates_start.values:
-        function_dataframe.loc[(function_dataframe["Reporter_Country_Code"] == country) & (function_dataframe["Year"] < year), "Value"] = 0
-    for country, year in reporting_dates_end.values:
-        function_dataframe.loc[(function_dataframe["Reporter_Country_Code"] == country) & (function_dataframe["Year"] > year), "Value"] = 0
-
-    return function_dataframe
-
-@jit(nopython=True)
-def calculate_mrio_matrices(Z, p):
-    """JIT-compiled version of matrix calculations"""
-    summation_vector = np.ones(len(p))
-    x = p + Z @ summation_vector
-    
-    one_over_x = np.where(x != 0, 1.0/x, 0.0)
-    A = Z @ np.diag(one_over_x)
-    
-    I = np.eye(len(p))
-    R = np.linalg.pinv(I - A) @ np.diag(p) # note pseudo-inverse rather than inverse (inverse creates some extra)
-    
-    ac = x - Z.sum(axis=0)
-    c = ac * one_over_x
-    R_bar = np.diag(c) @ R
-    
-    return R_bar
-
-@jit(nopython=True)
-def calculate_naive_matrix(Z, p):
-    summation_vector = np.ones(len(p))
-    x = p + Z @ summation_vector
-    e = summation_vector @ Z
-    one_over_x = np.where(x != 0, 1.0/x, 0.0)
-    g = (x-e) * one_over_x
-    G = np.diag(g)
-    attributable_prod_and_import = Z + np.diag(p)
-    R_error = G @ attributable_prod_and_import
-    return R_error
-
-def mrio_model(item_code, year, p_data, prod_data):
+def reporting_mask(reporting_dates:pd.DataFrame, reporters:pd.Series, years:pd.Series) -> np.ndarray:
     """
-    Perform matrix operations for MRIO calculation
-    Equivalent to matrix.operation function in R
-    
-    Args:
-        item_code: Primary item code to process
-        year: Year to process
-        primary_data: DataFrame with trade data in primary equivalents
-        production_all: DataFrame with production data
-    
+    True where a reporter's data for a year lies within its reporting window in Reporting_Dates.xls
+    (after its latest start year and before its earliest end year)
+    """
+    start_year = reporting_dates.groupby("Country_Code")["Start_Year"].max()
+    end_year = reporting_dates.groupby("Country_Code")["End_Year"].min()
+    # missing windows compare as False, so countries without one are kept
+    before = years.to_numpy() < reporters.map(start_year).to_numpy(dtype=float)
+    after = years.to_numpy() > reporters.map(end_year).to_numpy(dtype=float)
+    return ~(before | after)
+
+def _trade_keys(consumers, producers, items, years) -> np.ndarray:
+    """One int64 per (consumer, producer, item, year)"""
+    return (((consumers.astype(np.int64) * 10000 + producers) * 100000 + items) * 10000 + years.astype(np.int64))
+
+def reconcile_trade(raw_trade_data:pd.DataFrame, reporting_dates:pd.DataFrame, prefer_import="import") -> pd.DataFrame:
+    """
+    Bilateral trade flows from the reported imports (5610) and exports (5910) in one pass:
+    flows outside the reporter's reporting window, within-country flows and zeros are dropped,
+    and where both partners reported a flow the preferred side's figure is kept
+
     Returns:
-        DataFrame with Consumer_Country_Code, Producer_Country_Code, Value, Item_Code, Year
+        DataFrame with Consumer_Country_Code, Producer_Country_Code, Element_Code, Item_Code, Year, Value
     """
+    if prefer_import not in ("import", "export"):
+        raise ValueError("prefer_import must be either 'import' or 'export'")
 
-    data_subset = p_data[(p_data["Year"] == year) & (p_data["primary_item"] == item_code)]
-    production_data_subset = prod_data[(prod_data["Year"] == year) & (prod_data["Item_Code"] == item_code)]
+    trade = raw_trade_data[raw_trade_data["Element_Code"].isin([5610, 5910])]
+    keep = (reporting_mask(reporting_dates, trade["Reporter_Country_Code"], trade["Year"])
+            & (trade["Reporter_Country_Code"] != trade["Partner_Country_Code"]).to_numpy()
+            & (trade["Value"] != 0).to_numpy())
+    trade = trade[keep]
+
+    # importers report the partner they bought from, exporters the one they sold to
+    is_import = (trade["Element_Code"] == 5610).to_numpy()
+    reporters = trade["Reporter_Country_Code"].to_numpy()
+    partners = trade["Partner_Country_Code"].to_numpy()
+    trade_data = pd.DataFrame({
+        "Consumer_Country_Code": np.where(is_import, reporters, partners),
+        "Producer_Country_Code": np.where(is_import, partners, reporters),
+        "Element_Code": trade["Element_Code"].to_numpy(),
+        "Item_Code": trade["Item_Code"].to_numpy(),
+        "Year": trade["Year"].to_numpy(),
+        "Value": trade["Value"].to_numpy(),
+    })
+
+    keys = _trade_keys(trade_data["Consumer_Country_Code"].to_numpy(), trade_data["Producer_Country_Code"].to_numpy(),
+                       trade_data["Item_Code"].to_numpy(), trade_data["Year"].to_numpy())
+    preferred = is_import if prefer_import == "import" else ~is_import
+    # preferred side first, so the first report of each flow is kept
+    rows = np.concatenate([np.flatnonzero(preferred), np.flatnonzero(~preferred)])
+    rows = rows[~pd.Series(keys[rows]).duplicated().to_numpy()]
+    return trade_data.iloc[rows]
+
+
+def production_floor(Z, p):
+    """Production raised to cover each country's net exports"""
+    sum_vector = np.ones(len(p))
+    imports = Z @ sum_vector
+    exports = sum_vector @ Z
+    production_minimum = exports - imports
+    production_minimum[production_minimum < 0] = 0
+    return np.where(p<production_minimum, production_minimum, p)
 
-    production_data_subset.loc[production_data_subset["Value"].isna(), "Value"] = 0
 
-    producers = production_data_subset["Area_Code"].unique()
-    importers = data_subset["Consumer_Country_Code"].unique()
-    exporters = data_subset["Producer_Country_Code"].unique()
+def item_system(data_subset, production_data_subset, raise_production=True):
+    """
+    Countries, trade matrix Z (consumers in rows, producers in columns) and production p of one
+    item. Production is raised to cover each country's net exports unless raise_production is False
 
-    traders = np.union1d(importers, exporters)
-    countries = np.union1d(producers, traders)
+    Args:
+        data_subset: trade data in primary equivalents for one year and item
+        production_data_subset: production data for the same year and item
+    """
+    consumers = data_subset["Consumer_Country_Code"].to_numpy()
+    producers_trade = data_subset["Producer_Country_Code"].to_numpy()
+    producers = production_data_subset["Area_Code"].to_numpy()
 
-    country_dict = {code: idx for idx, code in enumerate(countries)}
+    countries = np.union1d(producers, np.union1d(consumers, producers_trade))
 
+    # (consumer, producer) pairs are unique after grouping, so a scatter fills Z
     Z = np.zeros((len(countries), len(countries)))
-
-    for _, row in data_subset.iterrows():
-        i = country_dict[row["Consumer_Country_Code"]]
-        j = country_dict[row["Producer_Country_Code"]]
-        Z[i, j] = row["Value_Sum"] # denoted Z in Kastner 2011
+    Z[np.searchsorted(countries, consumers), np.searchsorted(countries, producers_trade)] = data_subset["Value_Sum"].to_numpy() # denoted Z in Kastner 2011
 
     Z[np.isnan(Z)] = 0
 
     p = np.zeros((len(countries),)) 
-    for _, row in production_data_subset.iterrows():
-        i = country_dict[row["Area_Code"]]
-        p[i] = row["Value"] # denoted p in Kastner 2011
-
-    sum_vector = np.ones(len(countries))
-    imports = Z @ sum_vector
-    exports = sum_vector @ Z
-    production_minimum = exports - imports
-    production_minimum[production_minimum < 0] = 0
-    p = np.where(p<production_minimum, production_minimum, p)
+    p[np.searchsorted(countries, producers)] = np.nan_to_num(production_data_subset["Value"].to_numpy(dtype=float), nan=0.0) # denoted p in Kastner 2011
 
-    R_bar = calculate_mrio_matrices(Z, p)
-    R_error = calculate_naive_matrix(Z, p)
-    R_rel_error = np.divide(np.abs(R_bar - R_error), np.where(R_bar != 0, R_bar, 1))
+    if raise_production:
+        p = production_floor(Z, p)
+    return countries, Z, p
 
-    R_bar = np.round(R_bar, 2)
-    # R_rel_error = np.round(R_rel_error, 5)
-    nonzero_mask = R_bar != 0
-    i_indices, j_indices = np.where(nonzero_mask)
 
-    if len(i_indices) == 0:
-        return []
-    
-    return [{
-        "Consumer_Country_Code": countries[i],
-        "Producer_Country_Code": countries[j], 
-        "Value_Sum": R_bar[i, j],
+def mrio_links(item_code, year, countries, entries) -> pd.DataFrame:
+    """The MRIO links of an item as a DataFrame, from the (i, j, R_bar, relative error) entries of its solve"""
+    i_indices, j_indices, R_bar, R_rel_error = entries
+    return pd.DataFrame({
+        "Consumer_Country_Code": countries[i_indices],
+        "Producer_Country_Code": countries[j_indices], 
+        "Value_Sum": R_bar,
         "primary_item": item_code,
         "Year": year,
-        "Value_Error": R_rel_error[i, j],
-    } for i, j in zip(i_indices, j_indices)]
+        "Value_Error": R_rel_error,
+    })
+
+
+def band_columns(ensemble):
+    """Names of the percentile columns written for an ensemble"""
+    return [f"Value_P{q:g}" for q in ensemble.get("percentiles", ENSEMBLE_PERCENTILES)]
+
+
+def mrio_model(item_code, year, data_subset, production_data_subset, solver="auto", strategy="direct", solver_log=None, previous_solve=None, ensemble=None, cache=None):
+    """
+    Perform matrix operations for MRIO calculation
+    Equivalent to matrix.operation function in R
+    
+    Args:
+        item_code: Primary item code to process
+        year: Year to process
+        data_subset: trade data in primary equivalents for this year and item
+        production_data_subset: production data for this year and item
+        solver: MRIO backend, "auto", "dense", "sparse" or "blocks" (see mrio_solvers)
+        strategy: "direct" (LU, pseudo-inverse only for ill-conditioned items) or "pinv"
+        solver_log: optional list to which the solver path taken for this item is appended
+        previous_solve: the item's solve of the previous year (a dict, updated in place), reused if Z and p are unchanged
+        ensemble: optional Monte Carlo settings ({"draws", "error_model", "percentiles", "seed"}, see
+            mrio_solvers.ensemble_bands), adding the percentiles of each link's value as Value_P<q> columns
+        cache: optional MrioCache, from which the solution is loaded if Z, p and the settings are unchanged
+    
+    Returns:
+        DataFrame with Consumer_Country_Code, Producer_Country_Code, Value_Sum, primary_item, Year, Value_Error
+    """
+
+    countries, Z, p = item_system(data_subset, production_data_subset)
+
+    # non-zero entries of R_bar (rounded to 2 decimals) and their relative difference to the naive attribution
+    cached, key = None, None
+    if (previous_solve and np.array_equal(previous_solve["countries"], countries)
+            and np.array_equal(previous_solve["Z"], Z) and np.array_equal(previous_solve["p"], p)):
+        (i_indices, j_indices, R_bar, R_rel_error) = previous_solve["entries"]
+        bands = previous_solve.get("bands")
+        info = dict(previous_solve["info"], path="previous year")
+    else:
+        if cache is not None:
+            key = cache.key(countries, Z, p, {"solver": solver, "strategy": strategy, "ensemble": ensemble})
+            cached = cache.get(key)
+        if cached is not None:
+            (i_indices, j_indices, R_bar, R_rel_error), bands = cached["entries"], cached["bands"]
+            info = dict(cached["info"], path="cache")
+        else:
+            (i_indices, j_indices, R_bar, R_rel_error), info = solve_mrio(Z, p, backend=solver, strategy=strategy)
+            bands = None
+        if previous_solve is not None:
+            previous_solve.update(countries=countries, Z=Z, p=p, entries=(i_indices, j_indices, R_bar, R_rel_error), info=info, bands=bands)
+    if ensemble and bands is None:
+        # seeded per item, so unchanged items get the same bands in every run
+        bands = ensemble_bands(Z, p, i_indices, j_indices,
+            n_draws=ensemble.get("draws", ENSEMBLE_DRAWS),
+            error_model=ensemble.get("error_model"),
+            percentiles=ensemble.get("percentiles", ENSEMBLE_PERCENTILES),
+            seed=[ensemble.get("seed", 0), int(item_code)])
+        if previous_solve is not None:
+            previous_solve["bands"] = bands
+    # only solutions solved here are stored (not those reused from the previous year or the cache)
+    if key is not None and cached is None:
+        cache.put(key, (i_indices, j_indices, R_bar, R_rel_error), info, bands)
+    if solver_log is not None:
+        solver_log.append({"Year": year, "Item_Code": item_code, "Countries": len(countries), "Flows": len(data_subset), **info})
+
+    m = mrio_links(item_code, year, countries, (i_indices, j_indices, R_bar, R_rel_error))
+    if ensemble:
+        for column, band in zip(band_columns(ensemble), bands):
+            m[column] = band
+    return m
+
+
+# environment variables read by the BLAS/OpenMP runtimes numpy, scipy and numba link against
+BLAS_THREAD_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "BLIS_NUM_THREADS", "VECLIB_MAXIMUM_THREADS"]
+
+
+@contextmanager
+def _limit_blas_threads(n_threads):
+    """Limit the BLAS threads of processes started inside the block (the current process is unaffected)"""
+    saved = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+    os.environ.update({var: str(n_threads) for var in BLAS_THREAD_VARS})
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _solve_item(ic, yr, data_subset, production_data_subset, solver, strategy, previous_solve, ensemble, cache):
+    """mrio_model in a worker process, returning its result, solver log entry, solve (for the next year) and cache hits and misses"""
+    solver_log = []
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    m = mrio_model(ic, yr, data_subset, production_data_subset, solver=solver, strategy=strategy,
+                   solver_log=solver_log, previous_solve=previous_solve, ensemble=ensemble, cache=cache)
+    if cache is not None:
+        hits, misses = cache.hits - hits, cache.misses - misses
+    return m, solver_log, previous_solve, (hits, misses)
+
+
+def solve_items(tasks, solver="auto", strategy="direct", n_workers=1, previous_solves=None, ensemble=None, cache=None):
+    """
+    Solve the MRIO models of several items, optionally in parallel
+
+    Args:
+        tasks: list of (item_code, year, data_subset, production_data_subset)
+        n_workers: number of worker processes; 1 solves the items in this process
+        previous_solves: {item_code: solve} carried from year to year, see mrio_model
+        ensemble: optional Monte Carlo settings, see mrio_model
+        cache: optional MrioCache of solutions, see mrio_model (its hits and misses include those of the workers)
+
+    Returns:
+        list of mrio_model results in the order of tasks, and the solver log entries
+    """
+    results = [None] * len(tasks)
+    solver_log = []
+    if n_workers <= 1 or len(tasks) <= 1:
+        for index, (ic, yr, data_subset, production_data_subset) in enumerate(tqdm(tasks, desc="    Processing MRIO models", leave=True, position=0)):
+            previous_solve = None if previous_solves is None else previous_solves.setdefault(ic, {})
+            results[index] = mrio_model(ic, yr, data_subset, production_data_subset,
+                                        solver=solver, strategy=strategy, solver_log=solver_log, previous_solve=previous_solve,
+                                        ensemble=ensemble, cache=cache)
+        return results, solver_log
+
+    n_workers = min(n_workers, len(tasks))
+    # workers are fresh (spawned) processes sharing the cores between them, so each
+    # gets its share of BLAS threads rather than one thread per core
+    blas_threads = max(1, (os.cpu_count() or 1) // n_workers)
+    # the solves scale with the cube of the number of countries: largest items first
+    sizes = [len(np.union1d(t[3]["Area_Code"], np.union1d(t[2]["Consumer_Country_Code"], t[2]["Producer_Country_Code"]))) for t in tasks]
+    order = sorted(range(len(tasks)), key=lambda index: sizes[index], reverse=True)
+
+    print(f"    Solving {len(tasks)} MRIO models on {n_workers} worker processes ({blas_threads} BLAS threads each)")
+    with _limit_blas_threads(blas_threads), ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {}
+        for index in order:
+            previous_solve = None if previous_solves is None else previous_solves.get(tasks[index][0], {})
+            futures[executor.submit(_solve_item, *tasks[index], solver, strategy, previous_solve, ensemble, cache)] = index
+        logs = {}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="    Processing MRIO models", leave=True, position=0):
+            index = futures[future]
+            results[index], logs[index], previous_solve, (hits, misses) = future.result()
+            if cache is not None:
+                cache.hits += hits
+                cache.misses += misses
+            if previous_solves is not None:
+                previous_solves[tasks[index][0]] = previous_solve
+    for index in range(len(tasks)):
+        solver_log.extend(logs[index])
+    return results, solver_log
 
 
 def calculate_conversion_factors(conversion_opt, content_factors, item_map):
@@ -160,52 +314,268 @@ def calculate_conversion_factors(conversion_opt, content_factors, item_map):
         return conversion_factors
 
 
-def calculate_trade_matrix(
-        conversion_opt="dry_matter",
-        prefer_import="import", 
-        year=2013,
-        historic="Historic",
-        results_dir=Path("./results")):
-    """Calculate Trade Matrix module for MRIO pipeline"""
+def trade_matrix_sources(historic="Historic"):
+    """FAOSTAT sources calculate_trade_matrix reads"""
+    sugar_processing_source = "fbs_historic" if historic == "Historic" else "fbs"
+    return ["trade", "production", sugar_processing_source]
+
+
+def trade_matrix_inputs(historic="Historic", path="./input_data"):
+    """
+    Other files calculate_trade_matrix is built from, used to check whether an existing trade matrix is current
+    (the FAOSTAT sources are tracked by their (Year, Item_Code) slices instead)
+    """
+    return [
+        Path(path) / "primary_item_map_feed.csv",
+        Path(path) / "Reporting_Dates.xls",
+        Path(path) / "content_factors_per_100g.xlsx",
+        Path(__file__),
+    ]
+
+
+def affected_primary_items(changes, historic="Historic", path="./input_data"):
+    """
+    Primary items whose MRIO models depend on changed FAOSTAT items
+
+    Args:
+        changes: {source: set of changed Item_Codes} for one year (see fao_diff.changed_items)
+
+    Returns:
+        set of primary item codes to recompute
+    """
+    item_map = pd.read_csv(Path(path) / "primary_item_map_feed.csv", encoding="Latin-1")
+    item_map.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
+    to_primary = dict(zip(item_map["FAO_code"], item_map["primary_item"]))
+    # sugar crops are modelled as the sugar aggregate (see calculate_trade_matrix)
+    to_primary.update({156: 2545, 157: 2545})
+
+    trade_source, production_source, sugar_processing_source = trade_matrix_sources(historic)
+    items = set()
+    for item in changes.get(trade_source, ()):
+        if item in to_primary:
+            items.add(to_primary[item])
+    for item in changes.get(production_source, ()):
+        items.add(item)
+        if to_primary.get(item) == 2545:
+            items.add(2545)
+    if changes.get(sugar_processing_source, set()) & {2536, 2537}:
+        items.add(2545)
+    return items
+
+
+# sugar cane and sugar beet are traded as the sugar aggregate and split again after the MRIO
+SUGAR_CROP_CODES = [156, 157]
+SUGAR_AGGREGATE = 2545
+
+
+def sugar_production_shares(production_all, conversion_factors):
+    """
+    Sugar crop production in sugar aggregate equivalents, and each crop's share of a country's sugar crop production
+
+    Returns:
+        (sugar aggregate production rows to add to the production data,
+         shares as Area_Code, Year, Item_Code, share)
+    """
+    # Filter production data for sugar crops and merge with conversion factors
+    sugar_production = production_all[production_all["Item_Code"].isin(SUGAR_CROP_CODES)].merge(
+        conversion_factors, 
+        left_on="Item_Code", 
+        right_on="FAO_code", 
+        how="left"
+    )
+    sugar_production["Value_new"] = sugar_production["Value"] * sugar_production["Conversion_factor"]
+
+    # Calculate shares for later use
+    sugar_shares = sugar_production.assign(
+        share=sugar_production["Value"] / sugar_production.groupby(["Area_Code", "Year"])["Value"].transform("sum"))
+    sugar_shares = sugar_shares[["Area_Code", "Year", "Item_Code", "share"]].query("share > 0")
+
+    # Add production data - group by key columns and aggregate
+    sugar_production = (sugar_production
+        .groupby(["Area_Code", "Area", "primary_item", "FAO_name_primary", 
+                "Element_Code", "Element", "Year_Code", "Year", "Unit"], observed=True)
+        .agg({"Value_new": "sum"})
+        .reset_index()
+        .query("Value_new > 0")
+        .rename(columns={"primary_item": "Item_Code", 
+                        "FAO_name_primary": "Item",
+                        "Value_new": "Value"})
+        .assign(Flag=" "))
+    return sugar_production, sugar_shares
+
+
+def sugar_processing_shares(sugar_processing, conversion_factors):
+    """
+    Each sugar crop's share of a country's sugar crop processing (food balance element 5131)
+
+    Returns:
+        DataFrame with Area_Code, Year, Item_Code (156/157), processing_share
+    """
+    sugar_processing = sugar_processing[
+        (sugar_processing["Item_Code"].isin([2536, 2537]))&
+        (sugar_processing["Element_Code"] == 5131)&
+        (sugar_processing["Area_Code"] < 300)&
+        (sugar_processing["Value"] > 0)].copy()
+    
+    sugar_processing['Value'] = sugar_processing['Value']*1000
+
+    sugar_processing["Item_Code"] = sugar_processing["Item_Code"].replace({2536: 156, 2537: 157})
+
+    sugar_processing = sugar_processing.merge(
+        conversion_factors, 
+        left_on="Item_Code", 
+        right_on="FAO_code", 
+        how="left"
+    )
+    
+    sugar_processing["Value_new"] = sugar_processing["Value"] * sugar_processing["Conversion_factor"]
+    sugar_processing["processing_share"] = (sugar_processing["Value_new"]
+        / sugar_processing.groupby(["Area_Code", "Year"])["Value_new"].transform("sum"))
+    return sugar_processing[["Area_Code", "Year", "Item_Code", "processing_share"]]
 
-    output_filename = results_dir / str(year) / ".mrio" / f"TradeMatrix_{prefer_import}_{conversion_opt}.csv"
+
+def sugar_crop_shares(production_shares, processing_shares, conversion_factors):
+    """
+    Share of each sugar crop in a country's sugar aggregate: its processing share, or its
+    production share where there is no processing data
+
+    Returns:
+        DataFrame with Area_Code, Year, Sugar_Crop_Code, Item_Code (2545), share, processing_share, control
+        and the crop's conversion factor
+    """
+    # Join sugar shares with processing data
+    sugar_crop_share = production_shares.merge(processing_shares, 
+        on=["Area_Code", "Year", "Item_Code"], 
+        how="left")
+
+    # Check if a crop does not appear in processing data but does in production
+    sugar_crop_share["control"] = sugar_crop_share.groupby(["Area_Code", "Year"])["processing_share"].transform("sum")
+    
+    # If that is the case, set the contribution to processing to zero
+    mask1 = (sugar_crop_share["processing_share"].isna() & 
+            (sugar_crop_share["control"] == 1))
+    sugar_crop_share.loc[mask1, "processing_share"] = 0
+
+    # For all cases where there is no processing data, set the shares to production shares
+    mask2 = sugar_crop_share["processing_share"].isna()
+    sugar_crop_share.loc[mask2, "processing_share"] = sugar_crop_share.loc[mask2, "share"]
+
+    sugar_crop_share = (sugar_crop_share
+        .rename(columns={"Item_Code": "Sugar_Crop_Code"})
+        .assign(Item_Code = SUGAR_AGGREGATE))
+
+    return sugar_crop_share.merge(
+        conversion_factors,
+        left_on="Sugar_Crop_Code",
+        right_on="FAO_code",
+        how="left")
+
+
+def allocate_sugar(sugar_trade_data, crop_shares, production_all):
+    """
+    Split the trade links of the sugar aggregate into sugar cane and sugar beet links. Domestic
+    links take the national production not accounted for by the crop's other links
+
+    Returns:
+        DataFrame with Consumer_Country_Code, Producer_Country_Code, Value, Item_Code, Year, Value_Error
+    """
+    sugar_data = sugar_trade_data.merge(
+        crop_shares,
+        left_on=["Year", "Item_Code", "Producer_Country_Code"],
+        right_on=["Year", "Item_Code", "Area_Code"],
+        how="left")
+
+    sugar_data["Value_new"] = sugar_data["Value"] * sugar_data["processing_share"] / sugar_data["Conversion_factor"]
+    sugar_data = sugar_data[["Consumer_Country_Code", "Producer_Country_Code", "Year", "Sugar_Crop_Code", "Value_new", "Value_Error"]]
+    sugar_data = sugar_data.rename(columns={"Value_new": "Value", "Sugar_Crop_Code": "Item_Code"})
+
+    sugar_production_2 = production_all[
+        production_all["Item_Code"].isin(SUGAR_CROP_CODES)
+        ].rename(columns={"Value": "national_production"})
+
+    # links of producers without sugar crop shares are dropped, and the rest kept in
+    # (producer, year, crop) order, as the per-group allocation did
+    keys = ["Producer_Country_Code", "Year", "Item_Code"]
+    sugar_data = sugar_data.dropna(subset=keys).sort_values(keys, kind="stable")
+    sugar_data["sugar_crop_total"] = sugar_data.groupby(keys)["Value"].transform("sum")
+
+    sugar_data = sugar_data.merge(
+        sugar_production_2,
+        left_on=["Year", "Item_Code", "Producer_Country_Code"],
+        right_on=["Year", "Item_Code", "Area_Code"],
+        how="left")
+
+    sugar_data["Value_new"] = sugar_data["Value"] + sugar_data["national_production"] - sugar_data["sugar_crop_total"]
+
+    mask_diagonal = (sugar_data["Producer_Country_Code"] == sugar_data["Consumer_Country_Code"])
+    sugar_data.loc[mask_diagonal, "Value"] = sugar_data.loc[mask_diagonal, "Value_new"]
+
+    return sugar_data[["Consumer_Country_Code", "Producer_Country_Code", "Value", "Item_Code", "Year", "Value_Error"]]
+
+
+def load_trade_sources(years, historic="Historic", path="./input_data") -> dict:
+    """
+    Read the files the trade matrices are built from, for one or several years
+
+    Returns:
+        dict of DataFrames: item_map, trade, reporting_dates, content_factors, sugar_processing, production
+    """
 
     print("    Loading trade data...")
 
     # File paths
-    item_map_filename = "input_data/primary_item_map_feed.csv" 
-    trade_filename = "input_data/Trade_DetailedTradeMatrix_E_All_Data_(Normalized).csv" # FAOSTAT import
-    reporting_filename = "input_data/Reporting_Dates.xls"
-    content_filename = "input_data/content_factors_per_100g.xlsx"
-    production_filename = "input_data/Production_Crops_Livestock_E_All_Data_(Normalized).csv"
-    sugar_processing_filename = f"input_data/FoodBalanceSheets{historic}_E_All_Data_(Normalized).csv"
+    item_map_filename = Path(path) / "primary_item_map_feed.csv"
+    reporting_filename = Path(path) / "Reporting_Dates.xls"
+    content_filename = Path(path) / "content_factors_per_100g.xlsx"
+    sugar_processing_source = "fbs_historic" if historic == "Historic" else "fbs"
 
 
-    # Load Files
+    # Load Files (FAOSTAT sources come from the columnar cache with underscored column names)
     item_map = pd.read_csv(item_map_filename, encoding="Latin-1")
-    raw_trade_data = pd.read_csv(trade_filename, encoding="Latin-1")
-    reporting_date = pd.read_excel(reporting_filename)
-    content_factors = pd.read_excel(content_filename, skiprows=1)
-    sugar_processing = pd.read_csv(sugar_processing_filename, encoding="Latin-1")                                
-    production = pd.read_csv(production_filename, low_memory=False)
+    # only the selected years' partitions and the columns used below are read
+    raw_trade_data = load_fao("trade", path, years=years, elements=[5610, 5910],
+        columns=["Reporter_Country_Code", "Partner_Country_Code", "Item_Code", "Element_Code", "Year", "Value"])
+    reporting_date = read_excel_cached(reporting_filename)
+    content_factors = read_excel_cached(content_filename, skiprows=1)
+    sugar_processing = load_fao(sugar_processing_source, path, years=years, elements=5131,
+        columns=["Area_Code", "Item_Code", "Element_Code", "Year", "Value"])
+    production = load_fao("production", path, years=years, elements=5510,
+        columns=["Area_Code", "Area", "Item_Code", "Item", "Element_Code", "Element", "Year_Code", "Year", "Unit", "Value"])
+
+    return {
+        "item_map": item_map,
+        "trade": raw_trade_data,
+        "reporting_dates": reporting_date,
+        "content_factors": content_factors,
+        "sugar_processing": sugar_processing,
+        "production": production,
+    }
+
+
+def prepare_trade_sources(sources) -> dict:
+    """
+    The parts of harmonise_trade_data that depend on neither the conversion option nor the
+    import/export preference: tidied item map, reporting dates, content factors and production
 
+    Returns:
+        dict with item_map, reporting_dates, content_factors, production_all, sugar_processing and trade (the raw trade data)
+    """
+    item_map = sources["item_map"].copy()
+    reporting_date = sources["reporting_dates"].copy()
+    content_factors = sources["content_factors"].copy()
+    raw_trade_data = sources["trade"]
+    production = sources["production"].copy()
 
     # Rename columns
     item_map.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-    raw_trade_data.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
     reporting_date.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
     content_factors.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-    sugar_processing.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-    production.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
 
     # fix missing data from indian cattle - data from FAO: https://www.fao.org/faostat/en/#data/SCL
     indian_cattle_prod = [998071.03, 989522.18, 980561.33, 971291.48, 960991.17, 931645.26, 913009.07, 899727.75, 901236.5, 915639.94, 915639.94, 915639.94, 915639.94, 915639.94]
-    production.loc[(production["Item_Code"]==867)&(production["Area_Code"]==100)&(production["Element_Code"]==5510)&(production["Year"]>=2010), "Value"] = indian_cattle_prod
-
-    # Select year
-    raw_trade_data = raw_trade_data[raw_trade_data["Year"] == year]
-    sugar_processing = sugar_processing[sugar_processing["Year"] == year]
-    production = production[production["Year"] == year]
+    indian_cattle_prod = dict(zip(range(2010, 2010 + len(indian_cattle_prod)), indian_cattle_prod))
+    cattle_mask = (production["Item_Code"]==867)&(production["Area_Code"]==100)&(production["Element_Code"]==5510)&(production["Year"].isin(indian_cattle_prod))
+    production.loc[cattle_mask, "Value"] = production.loc[cattle_mask, "Year"].map(indian_cattle_prod)
 
     # Tweaks for slightly different files
     production_all = production[["Area_Code", "Area", "Item_Code", "Item", "Element_Code", "Element", "Year_Code", "Year", "Unit", "Value"]]
@@ -223,37 +593,34 @@ def calculate_trade_matrix(
     # production_all = pd.concat([production_all, production_offals], ignore_index=True)
     production_all = production_all[(production_all["Area_Code"]<300) & (production_all["Element_Code"]==5510)]
 
-    # harmonise import and export data
-
-    data_import = raw_trade_data[raw_trade_data["Element_Code"] == 5610][["Reporter_Country_Code", "Partner_Country_Code", "Element_Code", "Item_Code", "Year", "Value"]]
-    data_export = raw_trade_data[raw_trade_data["Element_Code"] == 5910][["Partner_Country_Code", "Reporter_Country_Code", "Element_Code", "Item_Code", "Year", "Value"]]
+    return {
+        "item_map": item_map,
+        "reporting_dates": reporting_date,
+        "content_factors": content_factors,
+        "production_all": production_all,
+        "sugar_processing": sources["sugar_processing"],
+        "trade": raw_trade_data,
+    }
 
 
-    data_import = eliminate_dates(reporting_date, data_import)
-    data_export = eliminate_dates(reporting_date, data_export)
-
-    data_import.loc[data_import["Reporter_Country_Code"] == data_import["Partner_Country_Code"], "Value"] = 0
-    data_export.loc[data_export["Reporter_Country_Code"] == data_export["Partner_Country_Code"], "Value"] = 0
-    data_import = data_import[data_import["Value"] != 0]
-    data_export = data_export[data_export["Value"] != 0]
+def preferred_trade_data(prepared, prefer_import="import") -> pd.DataFrame:
+    """Bilateral trade flows of the prepared sources (see prepare_trade_sources), keeping the preferred side's reports"""
+    # harmonise import and export data
+    trade_data = reconcile_trade(prepared["trade"], prepared["reporting_dates"], prefer_import)
 
-    data_import.rename(columns={"Reporter_Country_Code": "Consumer_Country_Code", "Partner_Country_Code": "Producer_Country_Code"}, inplace=True)
-    data_export.rename(columns={"Reporter_Country_Code": "Producer_Country_Code", "Partner_Country_Code": "Consumer_Country_Code"}, inplace=True)
+    return trade_data.sort_values(["Consumer_Country_Code", "Producer_Country_Code"])
 
-    if prefer_import == "import":
-        trade_data = pd.concat([data_import, data_export], ignore_index=True)
-        trade_data = trade_data.drop_duplicates(subset=["Consumer_Country_Code", "Producer_Country_Code", "Year", "Item_Code"],
-                                                keep="first")
-    elif prefer_import == "export":
-        trade_data = pd.concat([data_export, data_import], ignore_index=True)
-        trade_data = trade_data.drop_duplicates(subset=["Consumer_Country_Code", "Producer_Country_Code", "Year", "Item_Code"],
-                                                keep="first")
-    else:
-        raise ValueError("prefer_import must be either 'import' or 'export'")
 
-    trade_data = trade_data.sort_values(["Consumer_Country_Code", "Producer_Country_Code"])
+def primary_trade_data(prepared, trade_data, conversion_opt="dry_matter") -> dict:
+    """
+    Trade converted to primary item equivalents with one conversion option, from the prepared
+    sources (see prepare_trade_sources) and reconciled trade flows (see preferred_trade_data)
 
-    conversion_factors = calculate_conversion_factors(conversion_opt, content_factors, item_map)
+    Returns:
+        dict as harmonise_trade_data
+    """
+    item_map = prepared["item_map"]
+    conversion_factors = calculate_conversion_factors(conversion_opt, prepared["content_factors"], item_map)
 
 
     trade_data = trade_data.merge(
@@ -273,52 +640,133 @@ def calculate_trade_matrix(
         (primary_data["primary_item"].notna()) &
         (primary_data["Value_Sum"].notna())]
 
+    return {
+        "primary_data": primary_data,
+        "production_all": prepared["production_all"],
+        "sugar_processing": prepared["sugar_processing"],
+        "conversion_factors": conversion_factors,
+        "item_map": item_map,
+    }
 
-    # Calculate sugar production and sugar production shares
-    sugar_crop_codes = [156, 157]
 
-    # Filter production data for sugar crops and merge with conversion factors
-    sugar_production = production_all[production_all["Item_Code"].isin(sugar_crop_codes)].merge(
-        conversion_factors, 
-        left_on="Item_Code", 
-        right_on="FAO_code", 
-        how="left"
-    )
-    sugar_production["Value_new"] = sugar_production["Value"] * sugar_production["Conversion_factor"]
+def harmonise_trade_data(sources, conversion_opt="dry_matter", prefer_import="import") -> dict:
+    """
+    Reconcile reported imports and exports and convert trade to primary item equivalents,
+    for all years in sources at once
 
-    # Calculate shares for later use
+    Returns:
+        dict with primary_data (trade in primary equivalents), production_all, sugar_processing,
+        conversion_factors and item_map
+    """
+    prepared = prepare_trade_sources(sources)
+    return primary_trade_data(prepared, preferred_trade_data(prepared, prefer_import), conversion_opt)
 
-    sugar_shares = sugar_production.groupby(["Area_Code"]).apply(lambda x: x.assign(share=x["Value"] / x["Value"].sum()))
-    sugar_shares = sugar_shares.reset_index()[["Area_Code", "Year", "Item_Code", "share"]].query("share > 0")
 
-    # Add production data - group by key columns and aggregate
-    sugar_production = (sugar_production
-        .groupby(["Area_Code", "Area", "primary_item", "FAO_name_primary", 
-                "Element_Code", "Element", "Year_Code", "Year", "Unit"])
-        .agg({"Value_new": "sum"})
-        .reset_index()
-        .query("Value_new > 0")
-        .rename(columns={"primary_item": "Item_Code", 
-                        "FAO_name_primary": "Item",
-                        "Value_new": "Value"})
-        .assign(Flag=" "))
+def trade_matrix_year(
+        year,
+        data,
+        conversion_opt="dry_matter",
+        prefer_import="import",
+        results_dir=Path("./results"),
+        items=None,
+        solver="auto",
+        strategy="direct",
+        n_workers=1,
+        previous_solves=None,
+        trade_matrix_format="csv",
+        ensemble=None,
+        cache=None):
+    """
+    Solve the MRIO models and allocate sugar crops for one year of harmonised trade data
+    (see calculate_trade_matrix), writing the year's trade matrix
+    """
+
+    output_filename = trade_matrix_path(results_dir, year, "TradeMatrix", prefer_import, conversion_opt, trade_matrix_format)
+    mrio_filename = results_dir / str(year) / ".mrio" / f"MRIO_{prefer_import}_{conversion_opt}.parquet"
+    solver_log_filename = results_dir / str(year) / ".mrio" / f"SolverLog_{prefer_import}_{conversion_opt}.csv"
+    ensemble_filename = results_dir / str(year) / ".mrio" / f"Ensemble_{prefer_import}_{conversion_opt}.parquet"
+    output_filename.parent.mkdir(parents=True, exist_ok=True)
+
+    inputs = year_item_inputs(data)
+
+    cols = list(data["primary_data"].columns)
+    cols.append("Value_Error")
+    if ensemble:
+        cols.extend(band_columns(ensemble))
+
+    previous = {}
+    if items is not None and mrio_filename.exists():
+        previous = dict(tuple(pd.read_parquet(mrio_filename).groupby("primary_item")))
+        print(f"    Reusing MRIO results of {len(set(previous) - set(items))} unaffected items")
+
+    tasks = [task for task in inputs["tasks"] if task[0] not in previous or task[0] in items]
+    solved, solver_log = solve_items(tasks, solver=solver, strategy=strategy, n_workers=n_workers, previous_solves=previous_solves, ensemble=ensemble, cache=cache)
+    solved = {task[0]: m for task, m in zip(tasks, solved)}
+
+    mrio_output = []
+    for ic, *_ in inputs["tasks"]:
+        m = solved[ic] if ic in solved else previous[ic]
+        if len(m):
+            mrio_output.append(m)
+
+    solver_log = pd.DataFrame(solver_log, columns=["Year", "Item_Code", "Countries", "Flows", "backend", "path", "condition"])
+    solver_log.to_csv(solver_log_filename, index=False)
+    paths = solver_log.groupby(["backend", "path"]).size()
+    if len(paths):
+        print("    Solved " + ", ".join(f"{n} items by {backend} {path}" for (backend, path), n in paths.items()))
+
+    transformed_data = pd.concat(mrio_output, ignore_index=True) if mrio_output else pd.DataFrame(columns=cols)
+    transformed_data.to_parquet(mrio_filename, index=False)
+    if ensemble:
+        # percentile bands of the MRIO links (the sugar aggregate is not split into crops)
+        transformed_data.to_parquet(ensemble_filename, index=False)
+        transformed_data = transformed_data.drop(columns=band_columns(ensemble))
+
+    output_data = trade_matrix_output(year, data, inputs, transformed_data)
+    print("    Saving MRIO results...")
+    write_trade_matrix(output_data, output_filename)
+
+
+def year_item_inputs(data) -> dict:
+    """
+    The per-item MRIO inputs of one year of harmonised trade data
+
+    Returns:
+        dict with production_all (including the sugar aggregate), sugar_shares, and
+        tasks, the (item_code, year, data_subset, production_data_subset) of every traded item
+    """
+    primary_data = data["primary_data"]
+    production_all = data["production_all"]
+
+    # Calculate sugar production (as the sugar aggregate) and sugar production shares
+    sugar_production, sugar_shares = sugar_production_shares(production_all, data["conversion_factors"])
 
     # Add sugar production to main production data
     production_all = pd.concat([production_all, sugar_production], ignore_index=True)
 
     unique_combinations = primary_data[["Year", "primary_item"]].drop_duplicates()
 
-    
+    # split the trade and production data by (year, item) once rather than filtering per model
+    trade_groups = dict(tuple(primary_data.groupby(["Year", "primary_item"])))
+    production_groups = dict(tuple(production_all.groupby(["Year", "Item_Code"])))
+    no_production = production_all.iloc[0:0]
 
+    tasks = [(ic, yr, trade_groups[(yr, ic)], production_groups.get((yr, ic), no_production))
+             for yr, ic in unique_combinations.values]
+    return {"production_all": production_all, "sugar_shares": sugar_shares, "tasks": tasks}
 
-    mrio_output = []
-    for index, (yr, ic) in enumerate(tqdm(unique_combinations.values, desc="    Processing MRIO models", leave=True, position=0)):
-        m = mrio_model(ic, yr, primary_data, production_all)
-        mrio_output += m
-        
-    cols = list(primary_data.columns)
-    cols.append("Value_Error")
-    transformed_data = pd.DataFrame(mrio_output, columns=cols)
+
+def trade_matrix_output(year, data, inputs, transformed_data) -> pd.DataFrame:
+    """
+    The trade matrix of a year from its MRIO links (transformed_data, as returned by mrio_model):
+    adds the domestic use of untraded items and splits the sugar aggregate into sugar crops
+    """
+    primary_data = data["primary_data"]
+    sugar_processing = data["sugar_processing"]
+    conversion_factors = data["conversion_factors"]
+    item_map = data["item_map"]
+    production_all = inputs["production_all"]
+    sugar_shares = inputs["sugar_shares"]
 
     missing_data = production_all[
         (production_all["Element_Code"] == 5510) &
@@ -340,96 +788,169 @@ def calculate_trade_matrix(
 
     ###################################
 
-    sugar_trade_data = transformed_data[transformed_data["Item_Code"] == 2545]
-
-    sugar_processing = sugar_processing[
-        (sugar_processing["Item_Code"].isin([2536, 2537]))&
-        (sugar_processing["Element_Code"] == 5131)&
-        (sugar_processing["Area_Code"] < 300)&
-        (sugar_processing["Value"] > 0)]
-    
-    sugar_processing['Value'] = sugar_processing['Value']*1000
-
-    sugar_processing["Item_Code"] = sugar_processing["Item_Code"].replace({2536: 156, 2537: 157})
-
-    sugar_processing = sugar_processing.merge(
-        conversion_factors, 
-        left_on="Item_Code", 
-        right_on="FAO_code", 
-        how="left"
-    )
+    sugar_trade_data = transformed_data[transformed_data["Item_Code"] == SUGAR_AGGREGATE]
+    crop_shares = sugar_crop_shares(sugar_shares, sugar_processing_shares(sugar_processing, conversion_factors), conversion_factors)
+    sugar_data = allocate_sugar(sugar_trade_data, crop_shares, production_all)
     
-    sugar_processing["Value_new"] = sugar_processing["Value"] * sugar_processing["Conversion_factor"]
-
-    sugar_processing = sugar_processing.groupby(["Area_Code", "Year"]).apply(lambda x: x.assign(processing_share=x["Value_new"] / x["Value_new"].sum()))
-    sugar_processing = sugar_processing.reset_index()[["Area_Code", "Year", "Item_Code", "processing_share"]]
-
-    # Join sugar shares with processing data
-    sugar_crop_share = sugar_shares.merge(sugar_processing, 
-        on=["Area_Code", "Year", "Item_Code"], 
-        how="left")
+    output_data = pd.concat([transformed_data[transformed_data["Item_Code"] != SUGAR_AGGREGATE], sugar_data], ignore_index=True)
 
+    output_data["Error"] = output_data["Value_Error"] * output_data["Value"]
+    # transformed_data["Value"] = transformed_data["Value"].round(2)
+    return output_data[["Consumer_Country_Code", "Producer_Country_Code", "Item_Code", "Year", "Value", "Error"]]
 
-    # Check if a crop does not appear in processing data but does in production
-    sugar_crop_share = sugar_crop_share.groupby(["Area_Code", "Year"]).apply(lambda x: x.assign(control=x["processing_share"].sum(skipna=True)))    
-    sugar_crop_share = sugar_crop_share.reset_index()
-    
-    # If that is the case, set the contribution to processing to zero
-    mask1 = (sugar_crop_share["processing_share"].isna() & 
-            (sugar_crop_share["control"] == 1))
-    sugar_crop_share.loc[mask1, "processing_share"] = 0
 
-    # For all cases where there is no processing data, set the shares to production shares
-    mask2 = sugar_crop_share["processing_share"].isna()
-    sugar_crop_share.loc[mask2, "processing_share"] = sugar_crop_share.loc[mask2, "share"]
+def calculate_trade_matrices(
+        years,
+        conversion_opt="dry_matter",
+        prefer_import="import",
+        historic="Historic",
+        results_dir=Path("./results"),
+        items=None,
+        solver="auto",
+        strategy="direct",
+        n_workers=1,
+        trade_matrix_format="csv",
+        ensemble=None,
+        cache_size=None):
+    """
+    Calculate the trade matrices of several years, reading and harmonising the sources only once
 
-    sugar_crop_share = (sugar_crop_share
-        .rename(columns={"Item_Code": "Sugar_Crop_Code"})
-        .assign(Item_Code = 2545))
+    All years must use the same (historic or current) balance sheets. items is an optional
+    {year: primary item codes} of the items to recompute per year (see calculate_trade_matrix).
+    Items whose trade matrix and production are the same as in the previous year (e.g. carried
+    forward estimates) reuse that year's solution, so years should be given in order.
+    """
+    items = items or {}
+    calculate_trade_matrix_variants(
+        {(prefer_import, conversion_opt): {year: items.get(year) for year in years}},
+        historic=historic,
+        results_dir=results_dir,
+        solver=solver,
+        strategy=strategy,
+        n_workers=n_workers,
+        trade_matrix_format=trade_matrix_format,
+        ensemble=ensemble,
+        cache_size=cache_size)
+
+
+def calculate_trade_matrix_variants(
+        variants,
+        historic="Historic",
+        results_dir=Path("./results"),
+        solver="auto",
+        strategy="direct",
+        n_workers=1,
+        trade_matrix_format="csv",
+        ensemble=None,
+        cache_size=None):
+    """
+    Calculate the trade matrices of several conversion options and import/export preferences
+    at once. The sources are read and prepared once, the reported imports and exports are
+    reconciled once per preference, and only the conversion to primary item equivalents and
+    the MRIO solves are repeated per variant
 
-    sugar_crop_share = sugar_crop_share.merge(
-        conversion_factors,
-        left_on="Sugar_Crop_Code",
-        right_on="FAO_code",
-        how="left")
-    
-    sugar_data = sugar_trade_data.merge(
-        sugar_crop_share,
-        left_on=["Year", "Item_Code", "Producer_Country_Code"],
-        right_on=["Year", "Item_Code", "Area_Code"],
-        how="left")
+    Args:
+        variants: {(prefer_import, conversion_opt): {year: primary item codes to recompute, or None for all}}
+        cache_size: size limit in bytes of the cache of MRIO solutions in results_dir/.cache/mrio (see mrio_cache), None for no cache
+        other arguments as in calculate_trade_matrices
+    """
+    cache = MrioCache(Path(results_dir) / MRIO_CACHE_SUBDIR, cache_size) if cache_size else None
+    years = sorted({year for variant_years in variants.values() for year in variant_years})
+    sources = load_trade_sources(years, historic)
+    prepared = prepare_trade_sources(sources)
+
+    # split the yearly tables shared by all variants once
+    shared_by_year = {key: dict(tuple(prepared[key].groupby("Year"))) for key in ["production_all", "sugar_processing"]}
+    for prefer_import in dict.fromkeys(prefer for prefer, _ in variants):
+        trade_data = preferred_trade_data(prepared, prefer_import)
+        for (prefer, conversion_opt), variant_years in variants.items():
+            if prefer != prefer_import:
+                continue
+            if len(variants) > 1:
+                print(f"    Trade matrices preferring {prefer_import} data with {conversion_opt} conversion...")
+            data = primary_trade_data(prepared, trade_data, conversion_opt)
+            by_year = dict(shared_by_year, primary_data=dict(tuple(data["primary_data"].groupby("Year"))))
+            previous_solves = {}
+            for year in sorted(variant_years):
+                print(f"    Trade matrix for {year}...")
+                year_data = dict(data)
+                for key, groups in by_year.items():
+                    year_data[key] = groups.get(year, data[key].iloc[0:0])
+                trade_matrix_year(
+                    year,
+                    year_data,
+                    conversion_opt=conversion_opt,
+                    prefer_import=prefer_import,
+                    results_dir=results_dir,
+                    items=variant_years[year],
+                    solver=solver,
+                    strategy=strategy,
+                    n_workers=n_workers,
+                    previous_solves=previous_solves,
+                    trade_matrix_format=trade_matrix_format,
+                    ensemble=ensemble,
+                    cache=cache)
+                # evict as we go, so a long run of years stays within the size limit
+                if cache is not None:
+                    cache.evict()
+
+    if cache is not None:
+        stats = cache.stats()
+        print(f"    MRIO cache: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evicted, "
+              f"{stats['entries']} entries ({stats['bytes'] / 1e6:.1f} MB)")
 
-    sugar_data["Value_new"] = sugar_data["Value"] * sugar_data["processing_share"] / sugar_data["Conversion_factor"]
-    sugar_data = sugar_data[["Consumer_Country_Code", "Producer_Country_Code", "Year", "Sugar_Crop_Code", "Value_new", "Value_Error"]]
-    sugar_data = sugar_data.rename(columns={"Value_new": "Value", "Sugar_Crop_Code": "Item_Code"})
 
-    sugar_production_2 = production_all[
-        production_all["Item_Code"].isin(sugar_crop_codes)
-        ].rename(columns={"Value": "national_production"})
-    
-    sugar_data = sugar_data.groupby(["Producer_Country_Code", "Year", "Item_Code"]).apply(lambda x: x.assign(sugar_crop_total=x["Value"].sum(skipna=True)))
-    sugar_data = sugar_data.reset_index()
+def calculate_trade_matrix(
+        conversion_opt="dry_matter",
+        prefer_import="import", 
+        year=2013,
+        historic="Historic",
+        results_dir=Path("./results"),
+        items=None,
+        solver="auto",
+        strategy="direct",
+        n_workers=1,
+        trade_matrix_format="csv",
+        ensemble=None,
+        cache_size=None):
+    """
+    Calculate Trade Matrix module for MRIO pipeline
 
-    sugar_data = sugar_data.merge(
-        sugar_production_2,
-        left_on=["Year", "Item_Code", "Producer_Country_Code"],
-        right_on=["Year", "Item_Code", "Area_Code"],
-        how="left")
+    The per-item MRIO results are also kept in .mrio/MRIO_{prefer_import}_{conversion_opt}.parquet.
+    If items (primary item codes) is given and those results exist, only the MRIO models of
+    these items are solved again and the rest are reused, e.g. after a FAOSTAT revision
+    that only changed a few items.
 
-    sugar_data["Value_new"] = sugar_data["Value"] + sugar_data["national_production"] - sugar_data["sugar_crop_total"]
+    solver selects the MRIO backend ("auto", "dense", "sparse" or "blocks") and strategy the way
+    (I - A)^-1 is computed ("direct" or "pinv", see mrio_solvers). The path taken for each
+    item is written to .mrio/SolverLog_{prefer_import}_{conversion_opt}.csv. With n_workers > 1
+    the items are solved concurrently in that many worker processes, largest items first.
 
-    mask_diagonal = (sugar_data["Producer_Country_Code"] == sugar_data["Consumer_Country_Code"])
-    sugar_data.loc[mask_diagonal, "Value"] = sugar_data.loc[mask_diagonal, "Value_new"]
+    The trade matrix is written to .mrio/TradeMatrix_{prefer_import}_{conversion_opt} as CSV or,
+    with trade_matrix_format="parquet", as typed Parquet (see trade_matrix_io).
 
-    sugar_data = sugar_data[["Consumer_Country_Code", "Producer_Country_Code", "Value", "Item_Code", "Year", "Value_Error"]]
-    
-    output_data = pd.concat([transformed_data[transformed_data["Item_Code"] != 2545], sugar_data], ignore_index=True)
+    With ensemble (e.g. {"draws": 200, "error_model": {"trade": 0.1, "production": 0.05},
+    "percentiles": [5, 50, 95]}) Z and p of every item are also perturbed and the draws solved
+    together (see mrio_solvers.ensemble_bands). The percentiles of each MRIO link are written to
+    .mrio/Ensemble_{prefer_import}_{conversion_opt}.parquet as Value_P<q> columns.
 
-    print("    Saving MRIO results...")
-    output_data["Error"] = output_data["Value_Error"] * output_data["Value"]
-    # transformed_data["Value"] = transformed_data["Value"].round(2)
-    output_data = output_data[["Consumer_Country_Code", "Producer_Country_Code", "Item_Code", "Year", "Value", "Error"]]
-    output_data.to_csv(output_filename, index=False)
+    With cache_size (in bytes), solutions are kept in results_dir/.cache/mrio keyed by each item's
+    Z, p and the solver settings, and items whose inputs are unchanged are loaded rather than
+    solved (see mrio_cache). The least recently used solutions beyond cache_size are evicted.
+    """
+    calculate_trade_matrices(
+        [year],
+        conversion_opt=conversion_opt,
+        prefer_import=prefer_import,
+        historic=historic,
+        results_dir=results_dir,
+        items=None if items is None else {year: items},
+        solver=solver,
+        strategy=strategy,
+        n_workers=n_workers,
+        trade_matrix_format=trade_matrix_format,
+        ensemble=ensemble,
+        cache_size=cache_size)
 
 if __name__ == "__main__":
     import os
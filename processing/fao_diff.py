@@ -0,0 +1,102 @@
+"""
+Slice-level diffs between FAOSTAT releases.
+
+FAOSTAT revises its bulk downloads several times a year, but a revision
+usually only touches a few years or items. Every cached source records a
+digest of each (Year, Item_Code) slice (see ingest_data), and stage outputs
+record the digests of the slices they were built from, so:
+
+- diff_source reports which slices of a newly downloaded source differ from
+  the cached previous version (before it is ingested)
+- year_slices / changed_items let main() recompute only the affected
+  trade matrix items, feed tables and country impact years
+
+Run as a script to report the changes of every source in input_data:
+
+    python -m processing.fao_diff [input_data]
+"""
+
+import json
+import sys
+
+from processing.ingest_data import (FAO_SOURCES, SLICES_FILE, cache_is_current, cache_path, iter_fao_chunks,
+                                    load_slices, slice_digests, source_file)
+
+
+def year_slices(sources, year, path="./input_data") -> dict:
+    """Digests of the cached slices of one year, as {source: {item: hex digest}}"""
+    return {source: load_slices(source, path).get(str(year), {}) for source in sources}
+
+
+def diff_slices(old: dict, new: dict) -> dict:
+    """
+    Slices that were added, removed or changed between two {year: {item: digest}} mappings
+
+    Returns:
+        {year: sorted list of item codes}
+    """
+    changes = {}
+    for year in sorted(set(old) | set(new), key=int):
+        old_items, new_items = old.get(year, {}), new.get(year, {})
+        items = [int(i) for i in set(old_items) | set(new_items) if old_items.get(i) != new_items.get(i)]
+        if items:
+            changes[int(year)] = sorted(items)
+    return changes
+
+
+def changed_items(recorded: dict, current: dict) -> dict:
+    """
+    Items whose slices differ between the slices a stage output was built from and the current ones
+    Both arguments are {source: {item: digest}} for a single year
+
+    Returns:
+        {source: set of item codes}
+    """
+    changes = {}
+    for source in set(recorded) | set(current):
+        diff = diff_slices({"0": recorded.get(source, {})}, {"0": current.get(source, {})})
+        if diff:
+            changes[source] = set(diff[0])
+    return changes
+
+
+def diff_source(source, path="./input_data") -> dict:
+    """
+    Compare a (new) FAOSTAT source file with the cached previous version without replacing the cache
+
+    Returns:
+        {year: sorted list of item codes} of the slices that changed, or None if there is no cached version
+    """
+    cache_dir = cache_path(source, path)
+    if not (cache_dir / SLICES_FILE).exists():
+        return None
+    if cache_is_current(source, path):
+        return {}
+    with open(cache_dir / SLICES_FILE, "r") as f:
+        old = json.load(f)
+    new = slice_digests(iter_fao_chunks(source, path))
+    return diff_slices(old, new)
+
+
+def report(path="./input_data") -> dict:
+    """Print and return the changed slices of every FAOSTAT source"""
+    changes = {}
+    for source in FAO_SOURCES:
+        if not source_file(source, path).exists():
+            continue
+        diff = diff_source(source, path)
+        changes[source] = diff
+        if diff is None:
+            print(f"{FAO_SOURCES[source]}: not cached yet")
+        elif not diff:
+            print(f"{FAO_SOURCES[source]}: unchanged")
+        else:
+            n_slices = sum(len(items) for items in diff.values())
+            print(f"{FAO_SOURCES[source]}: {n_slices} changed (Year, Item_Code) slices")
+            for year, items in diff.items():
+                print(f"    {year}: {items}")
+    return changes
+
+
+if __name__ == "__main__":
+    report(sys.argv[1] if len(sys.argv) > 1 else "./input_data")
@@ -0,0 +1,140 @@
+"""
+Pinned in-memory schemas for the FAOSTAT tables.
+
+Rather than relying on pandas type inference, every FAOSTAT table is read
+with a fixed, compact schema: area/item/element codes and years as small
+integers, names, units and flags as categoricals, and values as float64
+(or float32 if configured). The same schema is used when streaming the
+sources into the Parquet cache and when loading from it.
+
+Codes are parsed as nullable Int32 and checked before they are narrowed:
+codes outside the int16 range raise rather than wrap around, and columns
+with missing codes become the nullable Int16.
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# dtype of Value (and the Y#### columns of wide tables); set to "float32" to halve their memory
+VALUE_DTYPE = "float64"
+
+CODE = "int16"   # FAOSTAT area, item and element codes and years all fit in int16
+NULLABLE_CODE = "Int16"  # codes of columns with missing values
+PARSE_CODE = "Int32"  # codes as parsed from the CSVs, before the range check
+CODE_RANGE = (np.iinfo(CODE).min, np.iinfo(CODE).max)
+TEXT = "category"
+VALUE = "value"  # placeholder resolved to VALUE_DTYPE
+
+_AREA = {
+    "Area_Code": CODE,
+    "Area_Code_(M49)": TEXT,
+    "Area": TEXT,
+}
+_ITEM = {
+    "Item_Code": CODE,
+    "Item": TEXT,
+}
+_ELEMENT = {
+    "Element_Code": CODE,
+    "Element": TEXT,
+}
+_OBSERVATION = {
+    "Year_Code": CODE,
+    "Year": CODE,
+    "Unit": TEXT,
+    "Value": VALUE,
+    "Flag": TEXT,
+    "Note": TEXT,
+}
+
+FAO_SCHEMAS = {
+    "production": {**_AREA, **_ITEM, "Item_Code_(CPC)": TEXT, **_ELEMENT, **_OBSERVATION},
+    "trade": {
+        "Reporter_Country_Code": CODE,
+        "Reporter_Country_Code_(M49)": TEXT,
+        "Reporter_Countries": TEXT,
+        "Partner_Country_Code": CODE,
+        "Partner_Country_Code_(M49)": TEXT,
+        "Partner_Countries": TEXT,
+        **_ITEM,
+        "Item_Code_(CPC)": TEXT,
+        **_ELEMENT,
+        **_OBSERVATION,
+    },
+    "fbs": {**_AREA, **_ITEM, "Item_Code_(FBS)": TEXT, **_ELEMENT, **_OBSERVATION},
+    "fbs_historic": {**_AREA, **_ITEM, "Item_Code_(FBS)": TEXT, **_ELEMENT, **_OBSERVATION},
+    "sua": {**_AREA, **_ITEM, "Item_Code_(CPC)": TEXT, **_ELEMENT, **_OBSERVATION},
+    "commodity_balances": {**_AREA, **_ITEM, **_ELEMENT, **_OBSERVATION},
+    "land_use": {**_AREA, **_ITEM, **_ELEMENT, "Unit": TEXT},  # plus Y#### values and Y####F flags
+}
+
+
+def column_dtype(source, column):
+    """Pinned pandas dtype of an (underscored) column of a FAOSTAT table"""
+    dtype = FAO_SCHEMAS.get(source, {}).get(column)
+    if dtype is None:
+        # columns not listed explicitly (e.g. the year columns of wide tables)
+        if re.fullmatch(r"Y\d{4}", column):
+            dtype = VALUE
+        elif column.endswith("Code"):
+            dtype = CODE
+        else:
+            dtype = TEXT
+    return VALUE_DTYPE if dtype == VALUE else dtype
+
+
+def schema_dtypes(source, columns) -> dict:
+    """Mapping of column -> pinned pandas dtype"""
+    return {c: column_dtype(source, c) for c in columns}
+
+
+def parse_dtypes(source, columns) -> dict:
+    """Mapping of column -> dtype to parse the CSVs with (codes wide and nullable, checked by apply_schema)"""
+    return {c: PARSE_CODE if dtype == CODE else dtype for c, dtype in schema_dtypes(source, columns).items()}
+
+
+def check_code_range(values, name):
+    """Raise ValueError if any (non-missing) code does not fit in int16"""
+    values = pd.Series(values)
+    if len(values) and (values.min() < CODE_RANGE[0] or values.max() > CODE_RANGE[1]):
+        outside = values[(values < CODE_RANGE[0]) | (values > CODE_RANGE[1])].unique()[:5]
+        raise ValueError(f"{name}: codes outside the {CODE} range {CODE_RANGE}, e.g. {outside.tolist()}")
+
+
+def code_dtype(values, name) -> str:
+    """int16 for complete codes, the nullable Int16 if some are missing, after checking their range"""
+    check_code_range(values, name)
+    return NULLABLE_CODE if values.isna().any() else CODE
+
+
+def arrow_schema(source, columns) -> pa.Schema:
+    """Arrow schema matching the pinned dtypes, used when writing the Parquet cache"""
+    fields = []
+    for column in columns:
+        dtype = column_dtype(source, column)
+        if dtype == TEXT:
+            fields.append(pa.field(column, pa.dictionary(pa.int32(), pa.string())))
+        else:
+            fields.append(pa.field(column, pa.from_numpy_dtype(dtype)))
+    return pa.schema(fields)
+
+
+def apply_schema(df: pd.DataFrame, source) -> pd.DataFrame:
+    """Cast a FAOSTAT DataFrame to its pinned dtypes (no-op for columns already matching)"""
+    casts = {}
+    for column, dtype in schema_dtypes(source, df.columns).items():
+        current = df[column].dtype
+        if dtype == TEXT:
+            if not isinstance(current, pd.CategoricalDtype):
+                casts[column] = TEXT
+        elif dtype == CODE:
+            if current not in (CODE, NULLABLE_CODE):
+                casts[column] = code_dtype(df[column], f"{source}.{column}")
+        elif current != dtype:
+            casts[column] = dtype
+    if not casts:
+        return df
+    return df.astype(casts)
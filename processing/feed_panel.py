@@ -0,0 +1,178 @@
+"""
+Multi-year commodity-balance feed panel.
+
+The feed stage needs, for every country and year, the supply of each
+primary item available as feed (element 5521 "Feed" of the food balance
+sheets, plus the non-food commodity balances), converted to primary item
+equivalents. Rather than re-reading and harmonising the balance sheets
+for every year, build_feed_panel does this once for all years:
+
+- years before HISTORIC_BEFORE use FoodBalanceSheetsHistoric + CommodityBalances (non-food)
+- later years use FoodBalanceSheets (crops only, FAO_code < 867) + the SUA items
+  no longer reported as food (missing_item_codes)
+
+and stores the resulting (Area_Code, Year, Primary_Item_Code) panel as
+Parquet in input_data/.cache, one file per conversion option. The panel is
+rebuilt when any of its inputs change according to the input manifest.
+"""
+
+from pathlib import Path
+
+import pandas as pd
+
+from processing.ingest_data import CACHE_DIRNAME, available_years, load_fao, source_file
+from processing.manifest import input_manifest
+from processing.reference_cache import read_excel_cached
+
+# first year taken from the current (rather than historic) balance sheets, as in main
+HISTORIC_BEFORE = 2010
+
+FEED_PANEL_SOURCES = ["fbs_historic", "commodity_balances", "fbs", "sua"]
+
+# SUA items no longer reported in the food balance sheets
+MISSING_ITEM_CODES = [17, 767, 329, 332, 780, 335, 291, 269, 826, 634, 253, 821, 256, 259, 272, 270, 836, 789, 771, 238, 782, 809]
+
+
+def feed_panel_path(conversion_opt="dry_matter", path="./input_data") -> Path:
+    return Path(path) / CACHE_DIRNAME / f"feed_panel_{conversion_opt}.parquet"
+
+
+def feed_panel_files(path="./input_data"):
+    """Files other than the FAOSTAT sources the feed panel is built from"""
+    return [
+        Path(path) / "CB_to_primary_items_map.csv",
+        Path(path) / "content_factors_per_100g.xlsx",
+        Path(path) / "CB_code_FAO_code_for_conversion_factors.csv",
+        Path(__file__),
+    ]
+
+
+def feed_panel_inputs(path="./input_data"):
+    """Files the feed panel is built from"""
+    return [source_file(source, path) for source in FEED_PANEL_SOURCES] + feed_panel_files(path)
+
+
+def cb_conversion_factors(conversion_opt, cb_map, content_factors, cb_conversion_map) -> pd.DataFrame:
+    """Conversion factors from commodity balance items to their primary items"""
+    content_factors_cb = cb_conversion_map.merge(content_factors,
+        left_on="FAO_code",
+        right_on="Item_Code",
+        how="left"
+        ).drop(columns=["Item", "FAO_code", "FAO_name", "Item_Code"]
+        ).rename(columns={"CB_code": "Item_Code", "CB_name": "Item"})
+    content_factors_cb = content_factors_cb[["Item_Code", conversion_opt]]
+
+    joined = cb_map.merge(
+        content_factors_cb,
+        on="Item_Code",
+        how="left")
+    joined = joined.merge(
+        content_factors_cb,
+        left_on="Primary_Item_Code",
+        right_on="Item_Code",
+        how="left",
+        suffixes=("_x", "_y")).drop(columns=["Item_Code_y"]).rename(columns={"Item_Code_x": "Item_Code"})
+
+    joined["Conversion_factor"] = joined[f"{conversion_opt}_x"] / joined[f"{conversion_opt}_y"]
+    joined = joined.sort_values(by="Primary_Item_Code")
+
+    return joined[joined["Conversion_factor"].notna()][["Item_Code", "Primary_Item_Code", "Conversion_factor"]]
+
+
+def _historic_balances(years, path):
+    cb_crops_data = load_fao("fbs_historic", path, years=years, elements=5521)
+    cb_crops_data["Value"] = cb_crops_data["Value"]*1000
+    cb_crops_data["Unit"] = "t"
+    cb_crops_data2 = load_fao("commodity_balances", path, years=years, elements=5520)
+    return pd.concat([cb_crops_data, cb_crops_data2], ignore_index=True)
+
+
+def _current_balances(years, path, cb_conversion_map):
+    cb_crops_data = load_fao("fbs", path, years=years, elements=5521)
+    cb_crops_data["Value"] = cb_crops_data["Value"]*1000
+
+    # remove extra data to just leave crops
+    cb_crops_data = cb_crops_data.merge(
+        cb_conversion_map[["FAO_code", "CB_code"]],
+        left_on="Item_Code",
+        right_on="CB_code",
+        how="left")
+    cb_crops_data = cb_crops_data[cb_crops_data["FAO_code"]<867]
+    cb_crops_data = cb_crops_data.drop(columns=["FAO_code", "CB_code", "Note"])
+
+    # add missing data that is no longer reported as food
+    cb_crops_data2 = load_fao("sua", path, years=years, elements=5520, items=MISSING_ITEM_CODES)
+    # map FAO item codes to CB codes where available
+    cb_crops_data2 = cb_crops_data2.merge(
+        cb_conversion_map[["FAO_code", "CB_code"]],
+        left_on="Item_Code",
+        right_on="FAO_code",
+        how="left")
+    cb_crops_data2["Item_Code"] = cb_crops_data2["CB_code"].fillna(cb_crops_data2["Item_Code"])
+    cb_crops_data2.drop(columns=["FAO_code", "CB_code", "Note"], inplace=True)
+    return pd.concat([cb_crops_data, cb_crops_data2], ignore_index=True)
+
+
+def build_feed_panel(conversion_opt="dry_matter", path="./input_data", force=False) -> Path:
+    """
+    Build the (Area_Code, Year, Primary_Item_Code) feed supply panel for all available years
+
+    Args:
+        conversion_opt: content factor used to convert to primary item equivalents
+        path: input data directory
+        force: rebuild even if the cached panel is current
+
+    Returns:
+        path of the Parquet panel
+    """
+    panel_file = feed_panel_path(conversion_opt, path)
+    inputs = feed_panel_inputs(path)
+    params = {"conversion_opt": conversion_opt, "historic_before": HISTORIC_BEFORE}
+    manifest = input_manifest(path)
+    if not force and manifest.is_current(panel_file, inputs, params):
+        return panel_file
+
+    print(f"    Building {conversion_opt} feed panel...")
+    cb_map = pd.read_csv(Path(path) / "CB_to_primary_items_map.csv", encoding="Latin-1")
+    content_factors = read_excel_cached(Path(path) / "content_factors_per_100g.xlsx", skiprows=1)
+    content_factors.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
+    cb_conversion_map = pd.read_csv(Path(path) / "CB_code_FAO_code_for_conversion_factors.csv", encoding="Latin-1")
+    conversion_factors = cb_conversion_factors(conversion_opt, cb_map, content_factors, cb_conversion_map)
+
+    historic_years = [y for y in available_years("fbs_historic", path) if y < HISTORIC_BEFORE]
+    current_years = [y for y in available_years("fbs", path) if y >= HISTORIC_BEFORE]
+    cb_crops_data = pd.concat([
+        _historic_balances(historic_years, path),
+        _current_balances(current_years, path, cb_conversion_map)],
+        ignore_index=True)
+
+    cb_data = cb_crops_data.merge(
+        conversion_factors,
+        on="Item_Code",
+        how="left")
+
+    cb_data["Value_new"] = cb_data["Value"] * cb_data["Conversion_factor"]
+
+    feed_data = cb_data[(cb_data["Area_Code"]<300) & (cb_data["Primary_Item_Code"].notna())]
+    feed_data = (feed_data
+        .groupby(["Area_Code", "Year", "Primary_Item_Code"])
+        .agg({"Value_new": "sum"})
+        .reset_index()
+        .rename(columns={"Value_new": "Value"})
+        )
+
+    panel_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = panel_file.with_suffix(".tmp")
+    feed_data.to_parquet(tmp_file, index=False)
+    tmp_file.replace(panel_file)
+
+    manifest.record_artifact(panel_file, inputs, params)
+    manifest.save()
+    return panel_file
+
+
+def load_feed_panel(conversion_opt="dry_matter", year=None, path="./input_data") -> pd.DataFrame:
+    """Feed supply per (Area_Code, Year, Primary_Item_Code), optionally for a single year"""
+    panel_file = build_feed_panel(conversion_opt, path)
+    filters = None if year is None else [("Year", "=", year)]
+    return pd.read_parquet(panel_file, filters=filters)
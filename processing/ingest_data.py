@@ -0,0 +1,349 @@
+"""
+Columnar cache for the FAOSTAT bulk downloads.
+
+Each FAOSTAT source is parsed once and stored as Parquet in
+input_data/.cache, with spaces in column names replaced by underscores.
+Normalized sources are partitioned by year (one file per year) so a
+single-year stage only reads that year's rows; wide sources such as the
+land use table are stored as a single partition. Every later stage loads
+from the cache through load_fao rather than re-parsing the Latin-1 text.
+
+The CSVs are streamed in chunks straight out of the FAOSTAT zip archives,
+so the uncompressed files never have to be written to input_data. An
+already extracted CSV is used instead of the archive when present.
+
+Column types are pinned by the schema registry in fao_schemas (small
+integer codes, categorical text, configurable value precision) both when
+streaming and when loading.
+
+A cache is rebuilt when the content hash of its source, as recorded in the
+input manifest, changes; touching a file without editing it does not
+trigger a re-ingest. Alongside the partitions, every cache holds a digest of
+each (Year, Item_Code) slice (slices.json), so stages can tell which years
+and items a FAOSTAT revision actually changed (see fao_diff).
+"""
+
+import csv
+import io
+import json
+import os
+import re
+import shutil
+import zipfile
+from contextlib import contextmanager
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from processing.fao_schemas import apply_schema, arrow_schema, parse_dtypes
+from processing.manifest import input_manifest
+
+# short source names used by the pipeline -> FAOSTAT file stem
+FAO_SOURCES = {
+    "production": "Production_Crops_Livestock_E_All_Data_(Normalized)",
+    "trade": "Trade_DetailedTradeMatrix_E_All_Data_(Normalized)",
+    "fbs": "FoodBalanceSheets_E_All_Data_(Normalized)",
+    "fbs_historic": "FoodBalanceSheetsHistoric_E_All_Data_(Normalized)",
+    "sua": "SUA_Crops_Livestock_E_All_Data_(Normalized)",
+    "commodity_balances": "CommodityBalances_(non-food)_(-2013_old_methodology)_E_All_Data_(Normalized)",
+    "land_use": "Inputs_LandUse_E_All_Data",
+}
+
+CACHE_DIRNAME = ".cache"
+UNPARTITIONED = "all"
+SLICES_FILE = "slices.json"
+CHUNKSIZE = 1_000_000
+
+
+def normalise_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Replace spaces in column names with underscores"""
+    return df.rename(columns=lambda x: x.replace(" ", "_"))
+
+
+def _csv_path(source, path):
+    return Path(path) / f"{FAO_SOURCES[source]}.csv"
+
+
+def _zip_path(source, path):
+    return Path(path) / f"{FAO_SOURCES[source]}.zip"
+
+
+def source_file(source, path="./input_data") -> Path:
+    """The extracted CSV if present, otherwise the FAOSTAT zip archive"""
+    if source not in FAO_SOURCES:
+        raise ValueError(f"Unknown FAOSTAT source ({source}), expected one of {list(FAO_SOURCES)}")
+    csv_file = _csv_path(source, path)
+    return csv_file if csv_file.exists() else _zip_path(source, path)
+
+
+def _zip_member(zip_ref: zipfile.ZipFile, stem) -> str:
+    """Name of the data CSV inside a FAOSTAT archive (not the flag/code lists)"""
+    names = zip_ref.namelist()
+    if f"{stem}.csv" in names:
+        return f"{stem}.csv"
+    data_members = [i for i in zip_ref.infolist() if i.filename.endswith(".csv")]
+    if not data_members:
+        raise ValueError(f"No CSV member found in {zip_ref.filename}")
+    return max(data_members, key=lambda i: i.file_size).filename
+
+
+@contextmanager
+def open_source_text(source, path="./input_data"):
+    """Open a FAOSTAT source as a Latin-1 text stream, decompressing on the fly if zipped"""
+    src = source_file(source, path)
+    if not src.exists():
+        raise FileNotFoundError(f"FAOSTAT file not found: {src}")
+    if src.suffix == ".zip":
+        with zipfile.ZipFile(src, "r") as zip_ref:
+            with zip_ref.open(_zip_member(zip_ref, FAO_SOURCES[source])) as raw:
+                yield io.TextIOWrapper(raw, encoding="Latin-1", newline="")
+    else:
+        with open(src, "r", encoding="Latin-1", newline="") as f:
+            yield f
+
+
+def _isin(values):
+    return [values] if pd.api.types.is_scalar(values) else list(values)
+
+
+def iter_fao_chunks(source, path="./input_data", years=None, elements=None, items=None, columns=None, chunksize=CHUNKSIZE):
+    """
+    Stream a FAOSTAT source in chunks, filtering rows as they are decoded
+
+    Args:
+        source: key of FAO_SOURCES
+        path: input data directory
+        years, elements, items: optional values of Year, Element_Code and Item_Code to keep
+        columns: optional list of (underscored) columns to return
+        chunksize: rows decoded per chunk
+
+    Yields:
+        DataFrames with underscored column names
+    """
+    with open_source_text(source, path) as f:
+        raw_columns = next(csv.reader([f.readline()]))
+        normalised = {c: c.replace(" ", "_") for c in raw_columns}
+
+        filters = {"Year": years, "Element_Code": elements, "Item_Code": items}
+        filters = {col: _isin(v) for col, v in filters.items() if v is not None}
+        wanted = None
+        if columns is not None:
+            wanted = set(columns) | set(filters)
+
+        usecols = [c for c in raw_columns if wanted is None or normalised[c] in wanted]
+        dtypes = parse_dtypes(source, [normalised[c] for c in usecols])
+        reader = pd.read_csv(
+            f,
+            header=None,
+            names=raw_columns,
+            usecols=usecols,
+            dtype={c: dtypes[normalised[c]] for c in usecols},
+            chunksize=chunksize)
+
+        for chunk in reader:
+            chunk = chunk.rename(columns=normalised)
+            for col, values in filters.items():
+                chunk = chunk[chunk[col].isin(values)]
+            if columns is not None:
+                chunk = chunk[columns]
+            yield apply_schema(chunk, source)
+
+
+def read_fao_stream(source, path="./input_data", years=None, elements=None, items=None, columns=None, chunksize=CHUNKSIZE) -> pd.DataFrame:
+    """Read a filtered FAOSTAT source straight from its archive without building the cache"""
+    chunks = list(iter_fao_chunks(source, path, years, elements, items, columns, chunksize))
+    return apply_schema(pd.concat(chunks, ignore_index=True), source)
+
+
+def cache_path(source, path="./input_data") -> Path:
+    """Directory holding the year partitions of a FAOSTAT source"""
+    if source not in FAO_SOURCES:
+        raise ValueError(f"Unknown FAOSTAT source ({source}), expected one of {list(FAO_SOURCES)}")
+    return Path(path) / CACHE_DIRNAME / FAO_SOURCES[source]
+
+
+def partition_path(source, year, path="./input_data") -> Path:
+    return cache_path(source, path) / f"{year}.parquet"
+
+
+def cache_is_current(source, path="./input_data") -> bool:
+    """True if the cache exists and was built from the current contents of the source CSV or archive"""
+    cache_dir = cache_path(source, path)
+    if not (cache_dir / SLICES_FILE).exists():
+        return False
+    src = source_file(source, path)
+    if not src.exists():
+        return True
+    return input_manifest(path).is_current(cache_dir, inputs=[src])
+
+
+def available_years(source, path="./input_data") -> list:
+    """Years with a partition in the cache (empty for unpartitioned sources)"""
+    cache_dir = ingest_source(source, path)
+    return sorted(int(f.stem) for f in cache_dir.glob("*.parquet") if f.stem.isdigit())
+
+
+def _chunk_slice_digests(chunk: pd.DataFrame) -> pd.Series:
+    """
+    Digest of the rows of each (Year, Item_Code) slice of a chunk
+    Row hashes are summed (mod 2**64), so digests of the same slice from different chunks can be added
+    """
+    if "Year" in chunk.columns:
+        row_hashes = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+        keys = pd.DataFrame({"Year": chunk["Year"].to_numpy(), "Item_Code": chunk["Item_Code"].to_numpy(), "digest": row_hashes})
+    else:
+        # wide tables: one slice per year column and item
+        id_columns = [c for c in ("Area_Code", "Item_Code", "Element_Code") if c in chunk.columns]
+        frames = []
+        for column in chunk.columns:
+            if not re.fullmatch(r"Y\d{4}", column):
+                continue
+            row_hashes = pd.util.hash_pandas_object(chunk[id_columns + [column]], index=False).to_numpy()
+            frames.append(pd.DataFrame({"Year": int(column[1:]), "Item_Code": chunk["Item_Code"].to_numpy(), "digest": row_hashes}))
+        if not frames:
+            return pd.Series(dtype="uint64")
+        keys = pd.concat(frames, ignore_index=True)
+    return keys.groupby(["Year", "Item_Code"])["digest"].sum()
+
+
+def _add_slice_digests(slices: dict, digests: pd.Series):
+    for (year, item), digest in digests.items():
+        year_slices = slices.setdefault(str(year), {})
+        year_slices[str(item)] = (year_slices.get(str(item), 0) + int(digest)) % (1 << 64)
+
+
+def slice_digests(chunks) -> dict:
+    """Digests of every (Year, Item_Code) slice of a stream of chunks, as {year: {item: hex digest}}"""
+    slices = {}
+    for chunk in chunks:
+        _add_slice_digests(slices, _chunk_slice_digests(chunk))
+    return _format_slices(slices)
+
+
+def _format_slices(slices: dict) -> dict:
+    return {year: {item: f"{digest:016x}" for item, digest in items.items()} for year, items in slices.items()}
+
+
+def load_slices(source, path="./input_data") -> dict:
+    """Slice digests of the cached version of a source, as {year: {item: hex digest}}"""
+    cache_dir = ingest_source(source, path)
+    with open(cache_dir / SLICES_FILE, "r") as f:
+        return json.load(f)
+
+
+def write_partitions(chunks, cache_dir: Path, source):
+    """
+    Write a stream of chunks into one Parquet file per year in cache_dir,
+    together with the digests of each (Year, Item_Code) slice
+    The partitions are written to a temporary directory that replaces cache_dir
+    once complete, so an interrupted run never leaves a partial cache
+    """
+    tmp_dir = cache_dir.with_name(cache_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    writers = {}
+    schema = None
+    slices = {}
+    try:
+        for chunk in chunks:
+            _add_slice_digests(slices, _chunk_slice_digests(chunk))
+            if schema is None:
+                schema = arrow_schema(source, chunk.columns)
+            if "Year" in chunk.columns:
+                groups = chunk.groupby("Year", sort=False)
+            else:
+                groups = [(UNPARTITIONED, chunk)]
+            for year, year_df in groups:
+                if year not in writers:
+                    writers[year] = pq.ParquetWriter(tmp_dir / f"{year}.parquet", schema)
+                writers[year].write_table(pa.Table.from_pandas(year_df, schema=schema, preserve_index=False))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    with open(tmp_dir / SLICES_FILE, "w") as f:
+        json.dump(_format_slices(slices), f, sort_keys=True)
+
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+
+
+def ingest_source(source, path="./input_data", force=False) -> Path:
+    """Stream one FAOSTAT source (archive or extracted CSV) into the year-partitioned Parquet cache"""
+    cache_dir = cache_path(source, path)
+    if not force and cache_is_current(source, path):
+        return cache_dir
+
+    src = source_file(source, path)
+    if not src.exists():
+        raise FileNotFoundError(f"FAOSTAT file not found: {src}")
+
+    print(f"    Ingesting {src.name}...")
+    write_partitions(iter_fao_chunks(source, path), cache_dir, source)
+    manifest = input_manifest(path)
+    manifest.record_artifact(cache_dir, inputs=[src])
+    manifest.save()
+    return cache_dir
+
+
+def ingest_data(path="./input_data", force=False):
+    """
+    Build the Parquet cache for every available FAOSTAT source
+    Sources with neither an archive nor an extracted CSV are skipped
+    """
+    for source in FAO_SOURCES:
+        if not source_file(source, path).exists() and not cache_path(source, path).is_dir():
+            print(f"    Skipping {FAO_SOURCES[source]} (not found)")
+            continue
+        ingest_source(source, path, force=force)
+
+
+def load_fao(source, path="./input_data", years=None, elements=None, items=None, columns=None) -> pd.DataFrame:
+    """
+    Load a FAOSTAT source from the Parquet cache, building the cache on first use
+
+    Only the partitions of the requested years are opened, and element/item
+    filters and column selections are pushed down into the Parquet reader,
+    so memory scales with the selection rather than with the full
+    1961-present history.
+
+    Args:
+        source: key of FAO_SOURCES, e.g. "production" or "trade"
+        path: input data directory
+        years: optional year or list of years to read (normalized sources only)
+        elements: optional Element_Code value(s) to keep
+        items: optional Item_Code value(s) to keep
+        columns: optional list of (underscored) columns to read
+
+    Returns:
+        DataFrame with underscored column names
+    """
+    cache_dir = ingest_source(source, path)
+
+    filters = [(col, "in", _isin(v)) for col, v in (("Element_Code", elements), ("Item_Code", items)) if v is not None]
+    filters = filters or None
+
+    unpartitioned = cache_dir / f"{UNPARTITIONED}.parquet"
+    if unpartitioned.exists():
+        if years is not None:
+            raise ValueError(f"{FAO_SOURCES[source]} is not partitioned by year, select year columns instead")
+        return apply_schema(pd.read_parquet(unpartitioned, columns=columns, filters=filters), source)
+
+    if years is None:
+        files = sorted(cache_dir.glob("*.parquet"))
+    else:
+        files = [partition_path(source, y, path) for y in _isin(years)]
+        files = [f for f in files if f.exists()]
+
+    if not files:
+        # keep the schema so downstream filters still find their columns
+        schema_file = next(iter(sorted(cache_dir.glob("*.parquet"))))
+        return apply_schema(pd.read_parquet(schema_file, columns=columns).iloc[0:0], source)
+
+    frames = [pd.read_parquet(f, columns=columns, filters=filters) for f in files]
+    df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+    # concatenated categoricals with differing categories fall back to object, so recast
+    return apply_schema(df, source)
@@ -0,0 +1,164 @@
+"""
+Content-hash manifest for pipeline inputs and derived artifacts.
+
+A Manifest records the SHA-256 and size of files under a root directory
+(input_data/ or results/) in a JSON file. Hashes are only recomputed
+when a file's size or modification time changes, so repeated queries
+are cheap even for the multi-GB FAOSTAT archives.
+
+Derived artifacts (the Parquet cache, interpolated biodiversity values,
+trade matrices, ...) are recorded together with the hashes of the inputs
+and the parameters they were built from, and optionally the digests of the
+FAOSTAT (Year, Item_Code) slices they depend on. is_current then tells a
+stage whether an existing artifact can be reused, so a trivial edit to one
+input only invalidates what was actually built from it.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+MANIFEST_NAME = ".manifest.json"
+
+
+def file_digest(path) -> str:
+    """SHA-256 of a file's contents"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Manifest:
+    """
+    Hashes and sizes of the files under root, plus the inputs each artifact was built from
+
+    Args:
+        root: directory whose files are recorded (paths are stored relative to it)
+        manifest_file: JSON file to store the manifest in (default root/.manifest.json)
+    """
+
+    def __init__(self, root, manifest_file=None):
+        self.root = Path(root)
+        self.path = Path(manifest_file) if manifest_file is not None else self.root / MANIFEST_NAME
+        self.files = {}
+        self.artifacts = {}
+        if self.path.exists():
+            try:
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+                self.files = data.get("files", {})
+                self.artifacts = data.get("artifacts", {})
+            except (ValueError, OSError):
+                # an unreadable manifest only means everything is treated as changed
+                self.files, self.artifacts = {}, {}
+
+    def _key(self, path) -> str:
+        return Path(os.path.relpath(Path(path), self.root)).as_posix()
+
+    def digest(self, path):
+        """
+        Current SHA-256 of a file, reusing the recorded hash if its size and mtime are unchanged
+        Returns None for missing files and directories
+        """
+        path = Path(path)
+        if not path.is_file():
+            return None
+        stat = path.stat()
+        key = self._key(path)
+        entry = self.files.get(key)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["sha256"]
+        sha = file_digest(path)
+        self.files[key] = {"sha256": sha, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        return sha
+
+    def record(self, path, sha256=None):
+        """
+        Record the current hash and size of a file
+        sha256 may be passed when the caller already hashed the contents while writing them
+        """
+        if sha256 is None:
+            return self.digest(path)
+        stat = Path(path).stat()
+        self.files[self._key(path)] = {"sha256": sha256, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        return sha256
+
+    def changed(self, path) -> bool:
+        """True if a file is new or its contents differ from the recorded hash"""
+        entry = self.files.get(self._key(path))
+        previous = None if entry is None else entry["sha256"]
+        return self.digest(path) != previous
+
+    def scan(self, directory=None) -> list:
+        """
+        Record every file under directory (default root)
+        Returns the files that were new or whose contents changed
+        """
+        directory = self.root if directory is None else Path(directory)
+        changed = []
+        for path in sorted(directory.rglob("*")):
+            if not path.is_file() or path == self.path or path.suffix == ".tmp":
+                continue
+            if self.changed(path):
+                changed.append(path)
+        return changed
+
+    def record_artifact(self, artifact, inputs=(), params=None, slices=None):
+        """
+        Record that artifact was built from inputs (file paths) with params (JSON-serialisable)
+        slices optionally records the FAOSTAT slice digests it was built from ({source: {item: digest}})
+        """
+        self.artifacts[self._key(artifact)] = {
+            "sha256": self.digest(artifact),
+            "inputs": {self._key(p): self.digest(p) for p in inputs},
+            "params": params or {},
+            "slices": slices or {},
+        }
+
+    def stale_inputs(self, artifact, inputs=(), params=None):
+        """
+        Inputs whose contents changed since artifact was built from them
+        Returns None if artifact is unknown, missing, modified or was built with other params or inputs
+        """
+        artifact = Path(artifact)
+        entry = self.artifacts.get(self._key(artifact))
+        if entry is None or not artifact.exists():
+            return None
+        if artifact.is_file() and self.digest(artifact) != entry["sha256"]:
+            return None
+        if entry["params"] != (params or {}):
+            return None
+        if set(self._key(p) for p in inputs) != set(entry["inputs"]):
+            return None
+        return [p for p in inputs if self.digest(p) != entry["inputs"][self._key(p)]]
+
+    def recorded_slices(self, artifact) -> dict:
+        """FAOSTAT slice digests artifact was recorded with"""
+        entry = self.artifacts.get(self._key(artifact))
+        return {} if entry is None else entry.get("slices", {})
+
+    def is_current(self, artifact, inputs=(), params=None, slices=None) -> bool:
+        """
+        True if artifact exists, is unchanged since it was recorded, and was built
+        from exactly these inputs (with their current contents), params and slices
+        Directory artifacts are only checked for existence
+        """
+        if self.stale_inputs(artifact, inputs, params) != []:
+            return False
+        return self.recorded_slices(artifact) == (slices or {})
+
+    def save(self):
+        """Write the manifest atomically"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump({"files": self.files, "artifacts": self.artifacts}, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.path)
+
+
+def input_manifest(path="./input_data") -> Manifest:
+    """Manifest of the input data directory (stored alongside the caches)"""
+    return Manifest(path, Path(path) / ".cache" / "manifest.json")
@@ -0,0 +1,152 @@
+"""
+Content-addressed cache of per-item MRIO solutions.
+
+Rerunning the trade stage (after a code change, with skip_up_to_date off, or
+for another year with carried-forward data) solves every item again, although
+most items' trade matrix Z and production p are unchanged. MrioCache stores
+the non-zero entries of each solved R_bar and their relative errors (and the
+ensemble bands, if any) in results/.cache/mrio, keyed by a hash of the item's
+countries, Z and p, the solver settings and the contents of mrio_solvers.py,
+so unchanged items are loaded instead of solved and solver changes
+invalidate the cache.
+
+The cache is limited to max_bytes: every hit touches its entry, and evict
+(run after each year of the trade stage) removes the least recently used
+entries beyond the limit. Corrupt entries are removed when read. hits, misses and
+evictions are counted per MrioCache (see stats).
+"""
+
+import hashlib
+import json
+import os
+import zipfile
+from pathlib import Path
+
+import numpy as np
+
+import processing.mrio_solvers
+from processing.manifest import file_digest
+
+CACHE_SUBDIR = Path(".cache") / "mrio"
+
+# default size limit of the cache in bytes
+MRIO_CACHE_MAX_BYTES = 2 << 30
+
+_solver_digest = None
+
+
+def _solvers_digest() -> str:
+    """Hash of mrio_solvers.py, so changes to the solvers invalidate the cache"""
+    global _solver_digest
+    if _solver_digest is None:
+        _solver_digest = file_digest(Path(processing.mrio_solvers.__file__))
+    return _solver_digest
+
+
+class MrioCache:
+    """
+    Per-item MRIO solutions on disk, keyed by their inputs
+
+    Args:
+        directory: cache directory (results_dir/.cache/mrio in the pipeline)
+        max_bytes: size limit enforced by evict
+    """
+
+    def __init__(self, directory, max_bytes=MRIO_CACHE_MAX_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, countries, Z, p, settings) -> str:
+        """Hash of an item's inputs and the solver settings (a JSON-serialisable dict)"""
+        digest = hashlib.sha256()
+        digest.update(_solvers_digest().encode())
+        digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        for array in (np.asarray(countries, dtype=np.int64), np.ascontiguousarray(Z, dtype=float), np.ascontiguousarray(p, dtype=float)):
+            digest.update(str(array.shape).encode())
+            digest.update(array.tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key) -> Path:
+        return self.directory / f"{key}.npz"
+
+    def get(self, key):
+        """
+        The cached solution of key, or None
+
+        Returns:
+            dict with entries ((i, j, R_bar values, relative error) as solve_mrio), info and bands (None without an ensemble)
+        """
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as cached:
+                solution = {
+                    "entries": (cached["i"], cached["j"], cached["R_bar"], cached["rel_error"]),
+                    "info": json.loads(str(cached["info"])),
+                    "bands": cached["bands"] if "bands" in cached.files else None,
+                }
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+            # corrupt (e.g. partly written by a process that was killed), so removed to be stored again
+            path.unlink(missing_ok=True)
+            self.misses += 1
+            return None
+        # the modification time orders the entries for eviction
+        os.utime(path)
+        self.hits += 1
+        return solution
+
+    def put(self, key, entries, info, bands=None):
+        """Store the solution of key"""
+        i, j, R_bar, rel_error = entries
+        arrays = {"i": i, "j": j, "R_bar": R_bar, "rel_error": rel_error, "info": np.array(json.dumps(info, default=float))}
+        if bands is not None:
+            arrays["bands"] = bands
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        # per-process temporary name as solver workers may store the same entry concurrently
+        tmp_file = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_file, path)
+
+    def _entries(self):
+        entries = []
+        for path in self.directory.glob("*.npz"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return entries
+
+    def evict(self) -> int:
+        """Remove the least recently used entries beyond max_bytes, returning the number removed"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        self.evictions += removed
+        return removed
+
+    def stats(self) -> dict:
+        """Hits, misses and evictions so far, and the current number and size of entries"""
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+        }
@@ -0,0 +1,543 @@
+"""
+Solvers for the per-item MRIO model (Kastner et al. 2011).
+
+For an item with trade matrix Z (Z[i, j] = flow from producer j to
+consumer i) and production p:
+
+    x = p + Z 1                   total supply
+    A = Z diag(1/x)               import coefficients
+    R = (I - A)^-1 diag(p)        production embodied in supply
+    R_bar = diag(c) R             with c = (x - 1'Z) / x, the domestic use share
+
+and the naive (one-step) attribution used for the error estimate is
+R_error = diag(c) (Z + diag(p)).
+
+Two backends compute these:
+
+- dense: dense LU (or pseudo-inverse) of I - A
+- sparse: sparse LU factorisation of I - A, solving only for the columns with
+  non-zero production. Bilateral trade matrices of most items are very
+  sparse, so this avoids the O(n^3) cost for large items
+- blocks: many countries only produce, or only import, an item, and others
+  trade it within small clusters. Ordering the strongly connected components
+  of the trade graph (producer -> consumer) topologically makes I - A block
+  triangular, so (I - A)^-1 diag(p) is solved block by block, each block's
+  right-hand side including the supply from the blocks upstream of it. Only
+  the (small, dense) diagonal blocks are factorised; countries without supply
+  are dropped and single-country blocks are solved together by division
+
+and two strategies for (I - A)^-1:
+
+- direct: LU solve, after checking the (estimated) condition number of I - A.
+  Singular or ill-conditioned systems fall back to the pseudo-inverse
+- pinv: always use the pseudo-inverse, as in the original code
+
+Neither builds the diagonal matrices: diag(1/x), diag(p) and diag(c) are
+applied as row/column scalings, and fused_entries extracts the rounded
+non-zero entries of R_bar together with their relative difference to the
+naive attribution in one pass, without forming R_error.
+
+solve_mrio picks the backend from the size and density of Z unless told
+otherwise, and reports which path was taken for each item.
+
+For what-if scenarios, factorise_mrio keeps an item's base factorisation and
+update_mrio solves a perturbed Z and p by a Sherman-Morrison-Woodbury update of
+it: a few rows and columns of A covering its changed entries form a low-rank
+correction U V', and
+
+    (I - A - U V')^-1 = M^-1 + M^-1 U (I - V' M^-1 U)^-1 V' M^-1,   M = I - A
+
+so only the changed rows and columns are solved for rather than refactorising.
+
+ensemble_bands estimates the uncertainty of R_bar by Monte Carlo: Z and p
+are perturbed by multiplicative errors (ERROR_MODEL) and the draws are
+solved together, as stacked systems in one batched LAPACK call per chunk
+of draws. Every draw changes A (through both Z and x), so the base
+factorisation cannot be reused exactly, and iterating on it takes longer
+than refactorising.
+"""
+
+import warnings
+
+import numpy as np
+import scipy.linalg as sla
+import scipy.sparse as sp
+import scipy.sparse.csgraph as csgraph
+import scipy.sparse.linalg as spla
+from numba import jit
+
+# matrices smaller than this are always solved densely
+SPARSE_MIN_SIZE = 64
+# ... as are matrices with a larger share of non-zero trade flows
+SPARSE_MAX_DENSITY = 0.1
+# systems with a larger (estimated, 1-norm) condition number are solved with the pseudo-inverse
+MAX_CONDITION = 1e12
+
+# low-rank updates of a larger share of the rows and columns of A are solved from scratch
+MAX_UPDATE_RANK_SHARE = 0.5
+
+# relative standard deviations of the (log-normal, mean one) errors of the trade flows and production
+ERROR_MODEL = {"trade": 0.1, "production": 0.05}
+ENSEMBLE_DRAWS = 200
+ENSEMBLE_PERCENTILES = (5, 50, 95)
+# draws solved together are limited so their stacked (n, n) systems stay below this size
+ENSEMBLE_CHUNK_BYTES = 1 << 27
+
+# items with at least this many countries whose largest strongly connected component holds at most
+# BLOCKS_MAX_SHARE of them are solved by blocks. Smaller systems are solved as fast by one dense LU
+# (blocks break even at about 250 countries), so FAO items only use blocks if the backend is chosen
+BLOCKS_MIN_SIZE = 400
+BLOCKS_MAX_SHARE = 0.5
+
+BACKENDS = ("auto", "dense", "sparse", "blocks")
+STRATEGIES = ("direct", "pinv")
+
+
+class IllConditionedSystem(Exception):
+    """I - A is singular or too ill-conditioned for a direct solve"""
+    def __init__(self, condition):
+        super().__init__(f"condition number {condition:.3g}")
+        self.condition = condition
+
+
+@jit(nopython=True, cache=True)
+def supply_shares(Z, p):
+    """1/x (0 where there is no supply) and the domestic use shares c, computed once per item"""
+    n = len(p)
+    imports = Z.sum(axis=1)
+    exports = Z.sum(axis=0)
+    one_over_x = np.zeros(n)
+    c = np.zeros(n)
+    for i in range(n):
+        x = p[i] + imports[i]
+        if x != 0:
+            one_over_x[i] = 1.0 / x
+            c[i] = (x - exports[i]) * one_over_x[i]
+    return one_over_x, c
+
+
+@jit(nopython=True, cache=True)
+def leontief_matrix(Z, one_over_x):
+    """I - A, scaling the columns of Z by 1/x rather than multiplying by diag(1/x)"""
+    n = len(one_over_x)
+    I_minus_A = np.empty((n, n))
+    for i in range(n):
+        for j in range(n):
+            I_minus_A[i, j] = -Z[i, j] * one_over_x[j]
+        I_minus_A[i, i] += 1.0
+    return I_minus_A
+
+
+@jit(nopython=True, cache=True)
+def pinv_columns(I_minus_A, p, producers):
+    """(I - A)^+ diag(p) for the producer columns only (pseudo-inverse rather than inverse, as in the original code)"""
+    inverse = np.linalg.pinv(I_minus_A)
+    X = np.empty((len(p), len(producers)))
+    for k in range(len(producers)):
+        j = producers[k]
+        for i in range(len(p)):
+            X[i, k] = inverse[i, j] * p[j]
+    return X
+
+
+@jit(nopython=True, cache=True)
+def fused_entries(Z, p, c, X, producers):
+    """
+    Non-zero entries of R_bar = diag(c) X, rounded to 2 decimals, and their relative
+    difference to the naive attribution diag(c) (Z + diag(p)), where X holds the columns
+    of (I - A)^-1 diag(p) of the producers. The first pass counts the entries so only
+    the output arrays are allocated.
+    """
+    n, k = X.shape
+    count = 0
+    for i in range(n):
+        for col in range(k):
+            if np.rint(c[i] * X[i, col] * 100.0) != 0:
+                count += 1
+
+    rows = np.empty(count, np.int64)
+    cols = np.empty(count, np.int64)
+    values = np.empty(count)
+    rel_error = np.empty(count)
+    index = 0
+    for i in range(n):
+        for col in range(k):
+            r = c[i] * X[i, col]
+            rounded = np.rint(r * 100.0) / 100.0
+            if rounded != 0:
+                j = producers[col]
+                naive = Z[i, j] + p[j] if i == j else Z[i, j]
+                rows[index] = i
+                cols[index] = j
+                values[index] = rounded
+                rel_error[index] = np.abs(r - c[i] * naive) / r
+                index += 1
+    return rows, cols, values, rel_error
+
+
+def _lu_factor(I_minus_A):
+    """LU factors of I - A and its estimated condition number, raising IllConditionedSystem for singular or ill-conditioned I - A"""
+    with warnings.catch_warnings():
+        # exactly singular factors are caught by the condition estimate below
+        warnings.simplefilter("ignore", sla.LinAlgWarning)
+        lu, piv = sla.lu_factor(I_minus_A, check_finite=False)
+    rcond, info = sla.lapack.dgecon(lu, np.abs(I_minus_A).sum(axis=0).max(), norm="1")
+    condition = np.inf if rcond == 0 or info != 0 else 1.0 / rcond
+    if condition > MAX_CONDITION:
+        raise IllConditionedSystem(condition)
+    return (lu, piv), condition
+
+
+def _direct_columns(I_minus_A, p, producers):
+    """(I - A)^-1 diag(p) for the producer columns by LU solve, raising IllConditionedSystem for singular or ill-conditioned I - A"""
+    factors, condition = _lu_factor(I_minus_A)
+    return sla.lu_solve(factors, _production_rhs(p, producers), check_finite=False), condition
+
+
+def _production_rhs(p, producers):
+    """The producer columns of diag(p)"""
+    rhs = np.zeros((len(p), len(producers)))
+    rhs[producers, np.arange(len(producers))] = p[producers]
+    return rhs
+
+
+@jit(nopython=True, cache=True)
+def _component_levels(n_components, sources, targets):
+    """Topological level of each component of an acyclic graph given by its edges (Kahn's algorithm)"""
+    indegree = np.zeros(n_components, np.int64)
+    for e in range(len(targets)):
+        indegree[targets[e]] += 1
+    order = np.argsort(sources)
+    starts = np.searchsorted(sources[order], np.arange(n_components + 1))
+    level = np.zeros(n_components, np.int64)
+    queue = np.flatnonzero(indegree == 0)
+    queue = np.concatenate((queue, np.empty(n_components - len(queue), np.int64)))
+    head, tail = 0, n_components - len(np.flatnonzero(indegree))
+    while head < tail:
+        u = queue[head]
+        head += 1
+        for e in order[starts[u]:starts[u + 1]]:
+            v = targets[e]
+            level[v] = max(level[v], level[u] + 1)
+            indegree[v] -= 1
+            if indegree[v] == 0:
+                queue[tail] = v
+                tail += 1
+    return level
+
+
+def trade_blocks(Z):
+    """
+    Strongly connected components of the trade graph (an edge from producer j to consumer i
+    where Z[i, j] != 0) and their topological levels: every component is downstream only
+    of components of lower levels, so the components of one level are independent
+
+    Returns:
+        component label and level of each country
+    """
+    n = Z.shape[0]
+    consumers, producers = np.nonzero(Z)
+    graph = sp.csr_matrix((np.ones(len(consumers)), (producers, consumers)), shape=(n, n))
+    n_components, labels = csgraph.connected_components(graph, directed=True, connection="strong")
+    between = labels[producers] != labels[consumers]
+    level = _component_levels(n_components, labels[producers][between].astype(np.int64), labels[consumers][between].astype(np.int64))
+    return labels, level[labels]
+
+
+def choose_backend(Z) -> str:
+    """
+    Blocks for large items whose trade graph splits into small components, otherwise dense
+    for small or densely traded items and sparse for the rest
+    """
+    n = Z.shape[0]
+    if n < SPARSE_MIN_SIZE:
+        return "dense"
+    if n >= BLOCKS_MIN_SIZE:
+        labels, _ = trade_blocks(Z)
+        if np.bincount(labels).max() <= BLOCKS_MAX_SHARE * n:
+            return "blocks"
+    density = np.count_nonzero(Z) / (n * n)
+    return "sparse" if density <= SPARSE_MAX_DENSITY else "dense"
+
+
+def mrio_dense(Z, p, strategy="direct"):
+    """
+    Dense solve
+
+    Returns:
+        (i, j, R_bar values, relative error) at the non-zero entries of R_bar, and solver info
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown MRIO strategy ({strategy}), expected one of {STRATEGIES}")
+    one_over_x, c = supply_shares(Z, p)
+    I_minus_A = leontief_matrix(Z, one_over_x)
+    producers = np.flatnonzero(p)
+    path, condition = "pinv", np.nan
+    if strategy == "direct":
+        try:
+            X, condition = _direct_columns(I_minus_A, p, producers)
+            path = "lu"
+        except IllConditionedSystem as e:
+            condition = e.condition
+    if path == "pinv":
+        X = pinv_columns(I_minus_A, p, producers)
+    return fused_entries(Z, p, c, X, producers), {"backend": "dense", "path": path, "condition": condition}
+
+
+def mrio_sparse(Z, p):
+    """
+    Sparse LU solve of (I - A) X = diag(p), for the columns of X with non-zero production only
+
+    Returns:
+        (i, j, R_bar values, relative error) at the non-zero entries of R_bar, and solver info
+
+    Raises:
+        IllConditionedSystem if I - A is singular or ill-conditioned (use the dense pseudo-inverse instead)
+    """
+    n = len(p)
+    one_over_x, c = supply_shares(Z, p)
+
+    I_minus_A = (sp.identity(n, format="csc") - sp.csc_matrix(Z) @ sp.diags(one_over_x)).tocsc()
+    try:
+        lu = spla.splu(I_minus_A)
+    except RuntimeError:
+        # exactly singular
+        raise IllConditionedSystem(np.inf)
+    inverse = spla.LinearOperator((n, n), matvec=lu.solve, rmatvec=lambda v: lu.solve(v, trans="T"))
+    condition = spla.onenormest(inverse) * spla.norm(I_minus_A, 1)
+    if not np.isfinite(condition) or condition > MAX_CONDITION:
+        raise IllConditionedSystem(condition)
+
+    producers = np.flatnonzero(p)
+    X = lu.solve(_production_rhs(p, producers))
+    return fused_entries(Z, p, c, X, producers), {"backend": "sparse", "path": "lu", "condition": condition}
+
+
+def mrio_blocks(Z, p):
+    """
+    Block triangular solve over the strongly connected components of the trade graph (see trade_blocks)
+
+    Returns:
+        (i, j, R_bar values, relative error) at the non-zero entries of R_bar, and solver info
+        (the condition number is the largest of the diagonal blocks')
+
+    Raises:
+        IllConditionedSystem if a diagonal block of I - A is singular or ill-conditioned (use the dense pseudo-inverse instead)
+    """
+    one_over_x, c = supply_shares(Z, p)
+    labels, levels = trade_blocks(Z)
+    producers = np.flatnonzero(p)
+    # countries without supply have no rows or columns in A and are dropped; the others are
+    # ordered by level and component, so levels and components are contiguous ranges
+    active = np.flatnonzero(one_over_x)
+    order = active[np.lexsort((labels[active], levels[active]))]
+    A = Z[np.ix_(order, order)] * one_over_x[order]
+    X = _production_rhs(p, producers)[order]
+    sizes = np.bincount(labels)[labels[order]]
+    level_starts = np.searchsorted(levels[order], np.arange(levels[order].max() + 2 if len(order) else 1))
+    block_starts = np.flatnonzero(np.r_[True, labels[order][1:] != labels[order][:-1], True])
+    blocks = [(block_start, block_stop) for block_start, block_stop in zip(block_starts[:-1], block_starts[1:]) if block_stop - block_start > 1]
+
+    condition = 1.0
+    for start, stop in zip(level_starts[:-1], level_starts[1:]):
+        # supply from upstream components, all solved at lower levels
+        if start:
+            X[start:stop] += A[start:stop, :start] @ X[:start]
+        single = np.flatnonzero(sizes[start:stop] == 1) + start
+        diagonal = 1.0 - A[single, single]
+        if (np.abs(diagonal) < 1.0 / MAX_CONDITION).any():
+            raise IllConditionedSystem(np.inf)
+        X[single] /= diagonal[:, None]
+        for block_start, block_stop in blocks:
+            if block_start < start or block_stop > stop:
+                continue
+            factors, block_condition = _lu_factor(np.eye(block_stop - block_start) - A[block_start:block_stop, block_start:block_stop])
+            X[block_start:block_stop] = sla.lu_solve(factors, X[block_start:block_stop], check_finite=False)
+            condition = max(condition, block_condition)
+
+    full = np.zeros((len(p), len(producers)))
+    full[order] = X
+    return fused_entries(Z, p, c, full, producers), {"backend": "blocks", "path": "lu", "condition": condition}
+
+
+def solve_mrio(Z, p, backend="auto", strategy="direct"):
+    """
+    Solve the MRIO model of one item
+
+    Args:
+        Z: (n, n) trade matrix, consumers in rows and producers in columns
+        p: (n,) production
+        backend: "auto", "dense", "sparse" or "blocks"
+        strategy: "direct" or "pinv" (the sparse and blocks backends always solve directly)
+
+    Returns:
+        (i, j, R_bar values rounded to 2 decimals, relative error |R_bar - R_error| / R_bar)
+        at the non-zero entries of the rounded R_bar, and a dict describing the path taken (backend, path ("lu" or "pinv"), estimated condition number)
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown MRIO backend ({backend}), expected one of {BACKENDS}")
+    if backend == "auto":
+        backend = choose_backend(Z)
+    if backend in ("sparse", "blocks") and strategy == "direct":
+        try:
+            return mrio_sparse(Z, p) if backend == "sparse" else mrio_blocks(Z, p)
+        except IllConditionedSystem as e:
+            # fall back to the dense pseudo-inverse
+            entries, info = mrio_dense(Z, p, "pinv")
+            info["condition"] = e.condition
+            return entries, info
+    return mrio_dense(Z, p, strategy)
+
+
+def _multiplicative_errors(rng, shape, sd):
+    """Log-normal errors with mean one and relative standard deviation sd"""
+    if not sd:
+        return np.ones(shape)
+    sigma = np.sqrt(np.log1p(sd ** 2))
+    return np.exp(rng.standard_normal(shape) * sigma - sigma ** 2 / 2)
+
+
+def perturbed_draws(Z, p, n_draws, error_model, rng):
+    """
+    Draws of Z (n_draws, n, n) and p (n_draws, n) with multiplicative errors on the non-zero
+    entries. As in the base model, production is raised to cover each country's net exports
+    """
+    rows, cols = np.nonzero(Z)
+    Z_draws = np.zeros((n_draws, *Z.shape))
+    Z_draws[:, rows, cols] = Z[rows, cols] * _multiplicative_errors(rng, (n_draws, len(rows)), error_model.get("trade", 0))
+    p_draws = p * _multiplicative_errors(rng, (n_draws, len(p)), error_model.get("production", 0))
+    return Z_draws, np.maximum(p_draws, Z_draws.sum(axis=1) - Z_draws.sum(axis=2))
+
+
+def _stacked_entries(Z_draws, p_draws, rows, cols):
+    """R_bar of each draw at the entries (rows, cols), solving all draws in one batched call"""
+    n_draws, n, _ = Z_draws.shape
+    imports = Z_draws.sum(axis=2)
+    x = p_draws + imports
+    one_over_x = np.divide(1.0, x, out=np.zeros_like(x), where=x != 0)
+    c = (x - Z_draws.sum(axis=1)) * one_over_x
+    I_minus_A = np.eye(n) - Z_draws * one_over_x[:, None, :]
+
+    producers, col_index = np.unique(cols, return_inverse=True)
+    rhs = np.zeros((n_draws, n, len(producers)))
+    rhs[:, producers, np.arange(len(producers))] = p_draws[:, producers]
+    try:
+        X = np.linalg.solve(I_minus_A, rhs)
+    except np.linalg.LinAlgError:
+        # a singular draw: the pseudo-inverse, as for singular base systems
+        X = np.linalg.pinv(I_minus_A) @ rhs
+    return c[:, rows] * X[:, rows, col_index]
+
+
+def ensemble_bands(Z, p, rows, cols, n_draws=ENSEMBLE_DRAWS, error_model=None, percentiles=ENSEMBLE_PERCENTILES, seed=0):
+    """
+    Monte Carlo percentiles of R_bar at the entries (rows, cols), e.g. those returned by solve_mrio
+
+    Args:
+        Z, p: the item's trade matrix and production, as for solve_mrio
+        rows, cols: entries of R_bar to estimate
+        n_draws: number of draws
+        error_model: {"trade": sd, "production": sd}, relative standard deviations (default ERROR_MODEL)
+        percentiles: percentiles to return
+        seed: seed of the random draws
+
+    Returns:
+        (len(percentiles), len(rows)) array of percentiles, rounded to 2 decimals like R_bar
+    """
+    error_model = ERROR_MODEL if error_model is None else error_model
+    rng = np.random.default_rng(seed)
+    n = len(p)
+    if len(rows) == 0:
+        return np.zeros((len(percentiles), 0))
+    chunk = max(1, ENSEMBLE_CHUNK_BYTES // (8 * 3 * n * n))
+    values = []
+    for start in range(0, n_draws, chunk):
+        Z_draws, p_draws = perturbed_draws(Z, p, min(chunk, n_draws - start), error_model, rng)
+        values.append(_stacked_entries(Z_draws, p_draws, rows, cols))
+    return np.round(np.percentile(np.concatenate(values), percentiles, axis=0), 2)
+
+
+def factorise_mrio(Z, p):
+    """
+    Base solve of an item, kept for low-rank updates with update_mrio
+
+    Returns:
+        dict with Z, p, I - A, its LU factors, condition number, the producers and
+        X = (I - A)^-1 diag(p) for the producer columns
+
+    Raises:
+        IllConditionedSystem if I - A is singular or ill-conditioned
+    """
+    one_over_x, c = supply_shares(Z, p)
+    I_minus_A = leontief_matrix(Z, one_over_x)
+    producers = np.flatnonzero(p)
+    factors, condition = _lu_factor(I_minus_A)
+    X = sla.lu_solve(factors, _production_rhs(p, producers), check_finite=False)
+    return {"Z": Z, "p": p, "c": c, "I_minus_A": I_minus_A, "factors": factors, "condition": condition, "producers": producers, "X": X}
+
+
+def _low_rank_correction(delta, max_rank):
+    """
+    U, V with delta = U V', from rows and columns covering the changed entries of delta,
+    chosen greedily (each time the row or column with the most changed entries not yet
+    covered). Entries of a chosen row go to that row and the others to their chosen column,
+    so every changed entry is counted once. None if more than max_rank rows and columns are needed
+    """
+    n = delta.shape[0]
+    uncovered = delta != 0
+    rows, cols = [], []
+    while uncovered.any():
+        if len(rows) + len(cols) == max_rank:
+            return None
+        row_counts, col_counts = uncovered.sum(axis=1), uncovered.sum(axis=0)
+        if row_counts.max() >= col_counts.max():
+            i = int(row_counts.argmax())
+            rows.append(i)
+            uncovered[i] = False
+        else:
+            j = int(col_counts.argmax())
+            cols.append(j)
+            uncovered[:, j] = False
+    column_parts = delta[:, cols].copy()
+    column_parts[rows] = 0
+    identity = np.eye(n)
+    return np.hstack([column_parts, identity[:, rows]]), np.hstack([identity[:, cols], delta[rows].T])
+
+
+def update_mrio(base, Z, p):
+    """
+    Solve the MRIO model of an item whose Z and p differ from those of base (see factorise_mrio)
+    in a few rows and columns, by a Sherman-Morrison-Woodbury update of the base factorisation.
+    Changes to a large share of the system, or updates that make I - A ill-conditioned, are
+    solved from scratch with solve_mrio instead
+
+    Returns:
+        (i, j, R_bar values, relative error) as solve_mrio, and solver info (path "smw" and the rank of the update)
+    """
+    n = len(p)
+    one_over_x, c = supply_shares(Z, p)
+    I_minus_A = leontief_matrix(Z, one_over_x)
+    # I - A' = M - delta
+    correction = _low_rank_correction(base["I_minus_A"] - I_minus_A, int(MAX_UPDATE_RANK_SHARE * n))
+    if correction is None:
+        return solve_mrio(Z, p, backend="dense")
+    U, V = correction
+    rank = U.shape[1]
+
+    # M^-1 diag(p') for the producers: the base columns rescaled, and new solves for new producers
+    producers = np.flatnonzero(p)
+    base_producers = base["producers"]
+    in_base = np.isin(producers, base_producers)
+    Y = np.empty((n, len(producers)))
+    scaled = producers[in_base]
+    Y[:, in_base] = base["X"][:, np.searchsorted(base_producers, scaled)] * (p[scaled] / base["p"][scaled])
+    if not in_base.all():
+        Y[:, ~in_base] = sla.lu_solve(base["factors"], _production_rhs(p, producers[~in_base]), check_finite=False)
+
+    if rank:
+        G = sla.lu_solve(base["factors"], U, check_finite=False)
+        capacitance = np.eye(rank) - V.T @ G
+        if np.linalg.cond(capacitance, 1) > MAX_CONDITION:
+            return solve_mrio(Z, p, backend="dense")
+        Y += G @ np.linalg.solve(capacitance, V.T @ Y)
+    return fused_entries(Z, p, c, Y, producers), {"backend": "dense", "path": "smw", "condition": base["condition"], "rank": rank}
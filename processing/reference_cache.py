@@ -0,0 +1,71 @@
+"""
+Binary cache for the Excel reference workbooks.
+
+Workbooks such as nocsDataExport, content_factors_per_100g and the
+Planet-Based Diets data are parsed by openpyxl/xlrd in many places and,
+for the impacts stage, several times per country. read_excel_cached parses
+each (workbook, read options) combination once and stores the DataFrame
+as a pickle in input_data/.cache/reference, keyed by a hash of the
+workbook's contents, so edits to a workbook invalidate its cache. Pickle
+is used rather than Parquet because reference sheets often contain
+mixed-type columns.
+"""
+
+import hashlib
+import os
+import warnings
+from pathlib import Path
+
+import pandas as pd
+
+from processing.manifest import file_digest
+
+CACHE_SUBDIR = Path(".cache") / "reference"
+
+# in-process memo: (path, size, mtime, options) -> DataFrame
+_memo = {}
+
+
+def _options_key(kwargs) -> str:
+    return hashlib.sha256(repr(sorted(kwargs.items())).encode()).hexdigest()[:8]
+
+
+def read_excel_cached(path, **kwargs) -> pd.DataFrame:
+    """
+    Drop-in replacement for pd.read_excel backed by the reference cache
+
+    Args:
+        path: workbook path
+        **kwargs: passed to pd.read_excel (sheet_name, skiprows, header, ...)
+
+    Returns:
+        a fresh copy of the DataFrame, so callers may modify it in place
+    """
+    path = Path(path)
+    stat = path.stat()
+    options = _options_key(kwargs)
+    memo_key = (str(path.resolve()), stat.st_size, stat.st_mtime_ns, options)
+    if memo_key in _memo:
+        return _memo[memo_key].copy()
+
+    cache_dir = path.parent / CACHE_SUBDIR
+    cache_file = cache_dir / f"{path.stem}.{options}.{file_digest(path)[:16]}.pkl"
+
+    if cache_file.exists():
+        df = pd.read_pickle(cache_file)
+    else:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            df = pd.read_excel(path, **kwargs)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # remove caches of earlier versions of this workbook with the same options
+        for stale in cache_dir.glob(f"{path.stem}.{options}.*.pkl"):
+            if stale != cache_file:
+                stale.unlink(missing_ok=True)
+        # per-process temporary name as country workers may build the same entry concurrently
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        df.to_pickle(tmp_file)
+        os.replace(tmp_file, cache_file)
+
+    _memo[memo_key] = df
+    return df.copy()
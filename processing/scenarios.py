@@ -0,0 +1,191 @@
+"""
+What-if scenarios on the trade matrices (export bans, import stops, production shocks).
+
+A ScenarioEngine reads and harmonises one year of trade data once, and keeps
+the base factorisation of every item a scenario touches. Shocks scale the
+trade matrix Z or the production p of an item, and the new R_bar follows
+from a low-rank (Sherman-Morrison-Woodbury) update of the base solve (see
+mrio_solvers.update_mrio) rather than a new solve, so many scenarios can be
+explored interactively. Items are the primary items of the MRIO models, with
+the sugar crops traded as the sugar aggregate (2545), and countries are FAO
+area codes.
+
+Shocks are dicts, made with:
+
+- scale_exports(country, factor, item=None): a producer's exports (its column of Z),
+  e.g. factor 0 for an export ban
+- scale_imports(country, factor, item=None): a consumer's imports (its row of Z)
+- scale_flow(consumer, producer, factor, item=None): a single trade flow
+- scale_production(country, factor, item=None): e.g. factor 0.8 for a 20% harvest loss
+
+item None applies a shock to every item. Production is raised again to cover
+net exports after the shocks, as in the base model.
+
+A shock changes the rows or columns of A it scales and, through the total
+supply x, the columns of the countries whose imports or production change.
+A production change is thus a rank 1 update and an import stop a rank 2
+update (plus a column for each exporter whose production was raised to cover
+its net exports and changes with them), but an export ban also changes the
+columns of all importers that re-export the item, so banning the exports of a
+large trader touches most of the system; updates of a rank above
+MAX_UPDATE_RANK_SHARE of the countries are solved from scratch.
+
+ScenarioEngine.write writes the full trade matrix of a scenario to another
+results directory, from which the feed and country stages propagate it to
+feed attribution and impacts:
+
+    engine = ScenarioEngine(2018)
+    engine.write([scale_exports(351, 0, item=15)], "./results_no_wheat_from_china")
+    main.main(years=[2018], pipeline_components=[3, 4], results_dir="./results_no_wheat_from_china")
+"""
+
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from processing.calculate_trade_matrix import (harmonise_trade_data, item_system, load_trade_sources, mrio_links, production_floor,
+    solve_items, trade_matrix_output, year_item_inputs)
+from processing.feed_panel import HISTORIC_BEFORE
+from processing.mrio_solvers import IllConditionedSystem, factorise_mrio, solve_mrio, update_mrio
+from processing.trade_matrix_io import trade_matrix_path, write_trade_matrix
+
+
+def scale_exports(country, factor, item=None) -> dict:
+    return {"kind": "exports", "country": country, "factor": factor, "item": item}
+
+
+def scale_imports(country, factor, item=None) -> dict:
+    return {"kind": "imports", "country": country, "factor": factor, "item": item}
+
+
+def scale_flow(consumer, producer, factor, item=None) -> dict:
+    return {"kind": "flow", "consumer": consumer, "producer": producer, "factor": factor, "item": item}
+
+
+def scale_production(country, factor, item=None) -> dict:
+    return {"kind": "production", "country": country, "factor": factor, "item": item}
+
+
+def _shock_countries(shock):
+    if shock["kind"] == "flow":
+        return [shock["consumer"], shock["producer"]]
+    return [shock["country"]]
+
+
+def apply_shocks(countries, Z, p, shocks):
+    """
+    Z and production (before raising it to cover net exports) of an item after the shocks.
+    Shocks of countries that are not part of the item's system have no effect
+    """
+    Z = Z.copy()
+    p = p.copy()
+    for shock in shocks:
+        k = np.searchsorted(countries, _shock_countries(shock))
+        if (k >= len(countries)).any() or (countries[k] != _shock_countries(shock)).any():
+            continue
+        if shock["kind"] == "exports":
+            Z[:, k[0]] *= shock["factor"]
+        elif shock["kind"] == "imports":
+            Z[k[0], :] *= shock["factor"]
+        elif shock["kind"] == "flow":
+            Z[k[0], k[1]] *= shock["factor"]
+        elif shock["kind"] == "production":
+            p[k[0]] *= shock["factor"]
+        else:
+            raise ValueError(f"Unknown shock ({shock['kind']})")
+    return Z, p
+
+
+class ScenarioEngine:
+    """
+    One year of harmonised trade data and the base solves of its items, for solving scenarios
+
+    Args:
+        year: year of the trade data
+        conversion_opt, prefer_import: as in calculate_trade_matrix
+        historic: "Historic" or "" (by default from the year, as in main)
+        path: input data directory
+        mrio_file: optional MRIO_{prefer_import}_{conversion_opt}.parquet of the trade stage for this year,
+            reused for the links of the items without shocks instead of solving them
+    """
+
+    def __init__(self, year, conversion_opt="dry_matter", prefer_import="import", historic=None, path="./input_data", mrio_file=None):
+        if historic is None:
+            historic = "Historic" if year < HISTORIC_BEFORE else ""
+        self.year = year
+        self.conversion_opt = conversion_opt
+        self.prefer_import = prefer_import
+        self.data = harmonise_trade_data(load_trade_sources([year], historic, path), conversion_opt, prefer_import)
+        self.inputs = year_item_inputs(self.data)
+        self.tasks = {int(task[0]): task for task in self.inputs["tasks"]}
+        self.mrio_file = mrio_file
+        self.solver_log = []
+        self._bases = {}
+        self._base_links = None
+
+    def base(self, item_code) -> dict:
+        """Countries, Z, production and base factorisation of an item (factors None if ill-conditioned)"""
+        item_code = int(item_code)
+        if item_code not in self._bases:
+            if item_code not in self.tasks:
+                raise ValueError(f"No MRIO model for item {item_code} in {self.year}")
+            _, _, data_subset, production_data_subset = self.tasks[item_code]
+            countries, Z, production = item_system(data_subset, production_data_subset, raise_production=False)
+            try:
+                factors = factorise_mrio(Z, production_floor(Z, production))
+            except IllConditionedSystem:
+                factors = None
+            self._bases[item_code] = {"countries": countries, "Z": Z, "production": production, "factors": factors}
+        return self._bases[item_code]
+
+    def _shocked_items(self, shocks):
+        items = {}
+        for shock in shocks:
+            for item_code in (self.tasks if shock["item"] is None else [int(shock["item"])]):
+                items.setdefault(item_code, []).append(shock)
+        return items
+
+    def solve(self, shocks) -> pd.DataFrame:
+        """MRIO links (as mrio_model returns them) of the items affected by the shocks"""
+        links = []
+        for item_code, item_shocks in self._shocked_items(shocks).items():
+            base = self.base(item_code)
+            Z, production = apply_shocks(base["countries"], base["Z"], base["production"], item_shocks)
+            p = production_floor(Z, production)
+            start = time.perf_counter()
+            if base["factors"] is None:
+                entries, info = solve_mrio(Z, p, backend="dense")
+            else:
+                entries, info = update_mrio(base["factors"], Z, p)
+            self.solver_log.append({"Item_Code": item_code, "Countries": len(p), **info, "seconds": time.perf_counter() - start})
+            links.append(mrio_links(self.tasks[item_code][0], self.year, base["countries"], entries))
+        return pd.concat(links, ignore_index=True) if links else pd.DataFrame()
+
+    def base_links(self) -> pd.DataFrame:
+        """MRIO links of all items without shocks"""
+        if self._base_links is None:
+            if self.mrio_file is not None and Path(self.mrio_file).exists():
+                self._base_links = pd.read_parquet(self.mrio_file)
+            else:
+                print(f"    Solving the base MRIO models of {self.year}...")
+                solved, _ = solve_items(list(self.inputs["tasks"]))
+                self._base_links = pd.concat([m for m in solved if len(m)], ignore_index=True)
+        return self._base_links
+
+    def trade_matrix(self, shocks) -> pd.DataFrame:
+        """Trade matrix of the year (as written by the trade stage) under the shocks"""
+        links = self.base_links()
+        shocked = self.solve(shocks)
+        if len(shocked):
+            links = pd.concat([links[~links["primary_item"].isin(shocked["primary_item"].unique())], shocked], ignore_index=True)
+        links = links[["Consumer_Country_Code", "Producer_Country_Code", "Value_Sum", "primary_item", "Year", "Value_Error"]]
+        return trade_matrix_output(self.year, self.data, self.inputs, links)
+
+    def write(self, shocks, results_dir, trade_matrix_format="csv") -> Path:
+        """Write the trade matrix of a scenario to results_dir, for the feed and country stages to pick up"""
+        output_filename = trade_matrix_path(results_dir, self.year, "TradeMatrix", self.prefer_import, self.conversion_opt, trade_matrix_format)
+        output_filename.parent.mkdir(parents=True, exist_ok=True)
+        write_trade_matrix(self.trade_matrix(shocks), output_filename)
+        return output_filename
@@ -0,0 +1,221 @@
+"""
+Reading and writing the trade matrices (TradeMatrix_* and TradeMatrixFeed_*).
+
+The trade and feed stages write their matrices as CSV by default. With the
+"parquet" format they are written as Parquet instead:
+
+- country, item and year codes as dictionary-encoded int16 (codes that are
+  missing for some rows, like the Animal_Product_Code of crops, stay null)
+- Value and Error as float64, or float32 to halve their size
+- rows sorted by consumer and item, so the row group statistics let readers
+  that only need some consumers skip the other row groups
+
+With the "arrow" format they are written as a memory-mapped COO store: an
+uncompressed Arrow IPC file holding the consumer, producer, item, value and
+error arrays, sorted by consumer and item, plus CSR-style indexes:
+
+- consumer offsets: the rows of consumer k are consumer_offsets[k]:consumer_offsets[k + 1]
+- producer offsets into Producer_Order, the row numbers sorted by producer
+
+so the rows of a few countries are found without scanning the matrix, and
+the arrays are shared through the page cache by every process reading them
+(see TradeMatrixStore).
+
+Everything downstream reads the matrices through read_trade_matrix, which
+returns the same columns whichever format was written, or open_trade_matrix
+to select the rows of some consumers, producers or items.
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from processing.fao_schemas import VALUE_DTYPE, check_code_range
+
+TRADE_MATRIX_FORMATS = ("csv", "parquet", "arrow")
+
+CODE_COLUMNS = ["Consumer_Country_Code", "Producer_Country_Code", "Item_Code", "Animal_Product_Code", "Year"]
+VALUE_COLUMNS = ["Value", "Error"]
+SORT_COLUMNS = ["Consumer_Country_Code", "Item_Code"]
+
+# rows per Parquet row group
+ROW_GROUP_SIZE = 1 << 17
+
+# schema metadata key of the store indexes, and the column holding the rows in producer order
+STORE_INDEX_KEY = b"trade_matrix_index"
+PRODUCER_ORDER = "Producer_Order"
+
+
+def trade_matrix_path(results_dir, year, name="TradeMatrix", prefer_import="import", conversion_opt="dry_matter", fmt="csv") -> Path:
+    """Path of a year's trade matrix (name is "TradeMatrix" or "TradeMatrixFeed")"""
+    if fmt not in TRADE_MATRIX_FORMATS:
+        raise ValueError(f"Unknown trade matrix format ({fmt}), expected one of {TRADE_MATRIX_FORMATS}")
+    return Path(results_dir) / str(year) / ".mrio" / f"{name}_{prefer_import}_{conversion_opt}.{fmt}"
+
+
+def _arrow_table(df: pd.DataFrame, value_dtype) -> pa.Table:
+    """Typed Arrow table of a trade matrix, without pandas metadata so codes with missing values read back as float like the CSV"""
+    arrays = []
+    for column in df.columns:
+        if column in CODE_COLUMNS:
+            check_code_range(df[column], column)
+            arrays.append(pa.array(df[column].to_numpy(), type=pa.int16(), from_pandas=True))
+        elif column in VALUE_COLUMNS:
+            arrays.append(pa.array(df[column].to_numpy(dtype=value_dtype), from_pandas=True))
+        else:
+            arrays.append(pa.array(df[column], from_pandas=True))
+    return pa.Table.from_arrays(arrays, names=list(df.columns))
+
+
+def _csr_index(codes: np.ndarray):
+    """Distinct codes of a sorted code array and the offsets of their rows"""
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.zeros(0, np.int64)
+    return codes[starts], np.r_[starts, len(codes)]
+
+
+def _sorted(df: pd.DataFrame) -> pd.DataFrame:
+    return df.sort_values([c for c in SORT_COLUMNS if c in df.columns], kind="stable")
+
+
+def _store_table(df: pd.DataFrame, value_dtype) -> pa.Table:
+    """Arrow table of a trade matrix sorted by consumer and item, with the producer order column and the indexes as metadata"""
+    df = _sorted(df)
+    table = _arrow_table(df, value_dtype)
+    consumers, consumer_offsets = _csr_index(df["Consumer_Country_Code"].to_numpy())
+    producer_order = np.argsort(df["Producer_Country_Code"].to_numpy(), kind="stable")
+    producers, producer_offsets = _csr_index(df["Producer_Country_Code"].to_numpy()[producer_order])
+
+    table = table.append_column(PRODUCER_ORDER, pa.array(producer_order.astype(np.int32)))
+    index = {
+        "consumers": consumers.astype(int).tolist(),
+        "consumer_offsets": consumer_offsets.astype(int).tolist(),
+        "producers": producers.astype(int).tolist(),
+        "producer_offsets": producer_offsets.astype(int).tolist(),
+    }
+    return table.replace_schema_metadata({STORE_INDEX_KEY: json.dumps(index)})
+
+
+def write_trade_matrix(df: pd.DataFrame, path, value_dtype=VALUE_DTYPE):
+    """Write a trade matrix as CSV, Parquet or an Arrow store, depending on the suffix of path"""
+    path = Path(path)
+    if path.suffix == ".csv":
+        df.to_csv(path, index=False)
+        return
+
+    tmp_file = path.with_suffix(".tmp")
+    if path.suffix == ".arrow":
+        table = _store_table(df, value_dtype)
+        with pa.OSFile(str(tmp_file), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    else:
+        pq.write_table(_arrow_table(_sorted(df), value_dtype), tmp_file,
+            row_group_size=ROW_GROUP_SIZE,
+            use_dictionary=[c for c in df.columns if c in CODE_COLUMNS])
+    tmp_file.replace(path)
+
+
+def read_trade_matrix(path) -> pd.DataFrame:
+    """Read a trade matrix written by write_trade_matrix"""
+    path = Path(path)
+    if path.suffix == ".arrow":
+        return TradeMatrixStore.open(path).frame()
+    if path.suffix == ".parquet":
+        return pd.read_parquet(path)
+    return pd.read_csv(path, encoding="Latin-1")
+
+
+def open_trade_matrix(path) -> "TradeMatrixStore":
+    """
+    Trade matrix with consumer and producer indexes: memory-mapped for the "arrow" format,
+    otherwise read and indexed in memory
+    """
+    path = Path(path)
+    if path.suffix == ".arrow":
+        return TradeMatrixStore.open(path)
+    return TradeMatrixStore(_store_table(read_trade_matrix(path), VALUE_DTYPE))
+
+
+class TradeMatrixStore:
+    """
+    Trade matrix sorted by consumer and item, with CSR-style indexes by consumer and producer
+
+    Opening a memory-mapped store only reads its footer and indexes. The rows of
+    a consumer are sliced without copying, and the rows of producers are gathered
+    through the producer index, so both cost O(rows returned).
+    """
+
+    def __init__(self, table: pa.Table):
+        index = json.loads(table.schema.metadata[STORE_INDEX_KEY])
+        self.consumers = np.array(index["consumers"], dtype=np.int64)
+        self.consumer_offsets = np.array(index["consumer_offsets"], dtype=np.int64)
+        self.producers = np.array(index["producers"], dtype=np.int64)
+        self.producer_offsets = np.array(index["producer_offsets"], dtype=np.int64)
+        self.producer_order = table.column(PRODUCER_ORDER).combine_chunks().to_numpy()
+        self.table = table.drop_columns([PRODUCER_ORDER]).replace_schema_metadata(None)
+
+    @classmethod
+    def open(cls, path):
+        """Memory-map a store written with the "arrow" format"""
+        with pa.memory_map(str(path), "r") as source:
+            return cls(pa.ipc.open_file(source).read_all())
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def column(self, name) -> np.ndarray:
+        """A column as a numpy array (a view of the mapped file unless it has missing values)"""
+        return self.table.column(name).combine_chunks().to_numpy(zero_copy_only=False)
+
+    @staticmethod
+    def _ranges(codes, offsets, selected):
+        """Start and stop offsets of the selected codes that are in the index"""
+        k = np.unique(np.searchsorted(codes, selected))
+        k = k[k < len(codes)]
+        k = k[np.isin(codes[k], selected)]
+        return offsets[k], offsets[k + 1]
+
+    def consumer_rows(self, consumers) -> np.ndarray:
+        """Row numbers of the given consumers (in row order)"""
+        starts, stops = self._ranges(self.consumers, self.consumer_offsets, np.asarray(consumers, dtype=np.int64))
+        if not len(starts):
+            return np.zeros(0, np.int64)
+        return np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)])
+
+    def producer_rows(self, producers) -> np.ndarray:
+        """Row numbers of the given producers (in row order)"""
+        starts, stops = self._ranges(self.producers, self.producer_offsets, np.asarray(producers, dtype=np.int64))
+        if not len(starts):
+            return np.zeros(0, np.int64)
+        return np.sort(np.concatenate([self.producer_order[start:stop] for start, stop in zip(starts, stops)]))
+
+    def rows(self, consumers=None, producers=None, items=None):
+        """Row numbers matching all the given selections (None for all rows)"""
+        rows = None
+        if consumers is not None:
+            rows = self.consumer_rows(consumers)
+        if producers is not None:
+            producer_rows = self.producer_rows(producers)
+            rows = producer_rows if rows is None else np.intersect1d(rows, producer_rows, assume_unique=True)
+        if items is not None:
+            item = self.column("Item_Code")
+            rows = np.flatnonzero(np.isin(item, items)) if rows is None else rows[np.isin(item[rows], items)]
+        return rows
+
+    def frame(self, rows=None, columns=None) -> pd.DataFrame:
+        """DataFrame of the given rows (all by default); a contiguous range of rows is sliced without copying the others"""
+        table = self.table if columns is None else self.table.select(columns)
+        if rows is not None:
+            if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+                table = table.slice(rows[0], len(rows))
+            else:
+                table = table.take(pa.array(rows, type=pa.int64()))
+        return table.to_pandas()
+
+    def select(self, consumers=None, producers=None, items=None, columns=None) -> pd.DataFrame:
+        """DataFrame of the rows of the given consumers, producers and items"""
+        return self.frame(self.rows(consumers, producers, items), columns)
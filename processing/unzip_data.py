@@ -8,40 +8,119 @@ Please cite ;-)
 Re-written in Python, October 2025 by Louis De Neve
 """
 
+import fnmatch
+import hashlib
 import os
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from pathlib import Path
 
-def unzip_data(path="./input_data"):
+from processing.manifest import input_manifest
+
+# Flag/code lists shipped in the FAOSTAT archives that the pipeline does not use
+UNNECESSARY_PATTERNS = ["*Flags.csv", "*AreaCodes.csv", "*Elements.csv", "*ItemCodes.csv", "*NOFLAG.csv"]
+# ... except the SUA item codes, which the provenance stage reads
+KEEP_PATTERNS = ["SUA*ItemCodes.csv"]
+
+
+def _is_needed(filename):
+    name = Path(filename).name
+    if any(fnmatch.fnmatch(name, pattern) for pattern in KEEP_PATTERNS):
+        return True
+    return not any(fnmatch.fnmatch(name, pattern) for pattern in UNNECESSARY_PATTERNS)
+
+
+def _member_params(zip_file, info):
+    """What an extracted file is recorded against in the manifest"""
+    return {"archive": Path(zip_file).name, "crc": info.CRC, "size": info.file_size}
+
+
+def _extract_member(zip_file, member, target):
+    """
+    Extract one archive member to a temporary file that is renamed into place once complete
+    Returns the SHA-256 of the extracted contents
+    """
+    tmp_file = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+    h = hashlib.sha256()
+    try:
+        with zipfile.ZipFile(zip_file, "r") as zip_ref, zip_ref.open(member) as src, open(tmp_file, "wb") as dst:
+            # reading a member to the end raises BadZipFile if its CRC does not match
+            for block in iter(lambda: src.read(1 << 20), b""):
+                h.update(block)
+                dst.write(block)
+        os.replace(tmp_file, target)
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
+    return h.hexdigest()
+
+
+def unzip_data(path="./input_data", max_workers=None):
     """
     Unzip FAOSTAT data files
     This function should be executed to unzip the data from FAOSTAT if not already done
+
+    Members are extracted concurrently, each to a temporary file renamed into place
+    once its CRC has been verified. Every extracted file is recorded in the input
+    manifest with its archive CRC and size, so files left over from an interrupted
+    or older extraction, or modified since, are extracted again rather than reused.
+
+    Args:
+        path: input data directory containing the archives
+        max_workers: number of extraction threads (default: ThreadPoolExecutor's default)
     """
-    
+
     # Look for zip files in the path directory
-    zip_files = list(Path(path).glob("*.zip"))
-    
+    zip_files = sorted(Path(path).glob("*.zip"))
+
     if not zip_files:
         print("No zip files to extract")
         return
-    
+
+    manifest = input_manifest(path)
+
+    tasks = []
     for zip_file in zip_files:
         with zipfile.ZipFile(zip_file, "r") as zip_ref:
-            if os.path.exists(f"{path}/{zip_ref.namelist()[0]}"):
+            for info in zip_ref.infolist():
+                if info.is_dir() or not _is_needed(info.filename):
+                    continue
+                target = Path(path) / Path(info.filename).name
+                if manifest.is_current(target, params=_member_params(zip_file, info)):
+                    continue
+                tasks.append((zip_file, info, target))
+
+    # largest members first so the long extractions overlap with the rest
+    tasks.sort(key=lambda task: task[1].file_size, reverse=True)
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for zip_file, info, target in tasks:
+            print(f"Extracting {target.name} from {zip_file.name}...")
+            futures[executor.submit(_extract_member, zip_file, info.filename, target)] = (zip_file, info, target)
+        for future in as_completed(futures):
+            zip_file, info, target = futures[future]
+            try:
+                sha256 = future.result()
+            except Exception as e:
+                errors.append(f"{zip_file.name}/{info.filename}: {e}")
                 continue
-            else:
-                print(f"Extracting {zip_file}...")
-                zip_ref.extractall(path)
-
-    # Delete unnecessary files
-    # Delete unnecessary files: *Flags.csv, AreaCodes.csv, Elements.csv, ItemCodes.csv
-    unnecessary_patterns = ["*Flags.csv", "*AreaCodes.csv", "*Elements.csv", "*ItemCodes.csv", "*NOFLAG.csv"]
-    for pattern in unnecessary_patterns:
+            manifest.record(target, sha256=sha256)
+            manifest.record_artifact(target, params=_member_params(zip_file, info))
+            # saved per member so completed files survive an interrupted run
+            manifest.save()
+
+    # Delete unnecessary files left over from earlier extractions: *Flags.csv, AreaCodes.csv, Elements.csv, ItemCodes.csv
+    for pattern in UNNECESSARY_PATTERNS:
         for file in Path(path).glob(pattern):
-            if str(file)[11:14] == "SUA" and pattern == "*ItemCodes.csv":
+            if _is_needed(file):
                 continue
             try:
                 file.unlink()
             except Exception as e:
                 print(f"Error deleting {file}: {e}")
+
+    if errors:
+        raise RuntimeError(f"Failed to extract {len(errors)} file(s): {'; '.join(errors)}")
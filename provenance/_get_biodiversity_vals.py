@@ -2,16 +2,28 @@ import pandas as pd
 import os
 import numpy as np
 
+from processing.manifest import input_manifest
+
+
+def interpolation_inputs(year, spam_years, datPath):
+    """Files an interpolated biodiversity year is built from"""
+    year1 = max([yr for yr in spam_years if yr < year])
+    year2 = min([yr for yr in spam_years if yr > year])
+    return [os.path.join(datPath, "mapspam_outputs", "outputs", str(year1), f"processed_results_{year1}.csv"),
+            os.path.join(datPath, "mapspam_outputs", "outputs", str(year2), f"processed_results_{year2}.csv"),
+            os.path.join(datPath, "commodity_crosswalk.csv")]
+
 
 def interpolate_vals(year, spam_years, datPath):
     year1 = max([yr for yr in spam_years if yr < year])
     year2 = min([yr for yr in spam_years if yr > year])
+    inputs = interpolation_inputs(year, spam_years, datPath)
 
-    df1 = pd.read_csv(os.path.join(datPath, "mapspam_outputs", "outputs", str(year1), f"processed_results_{year1}.csv"))
-    df2 = pd.read_csv(os.path.join(datPath, "mapspam_outputs", "outputs", str(year2), f"processed_results_{year2}.csv"))
+    df1 = pd.read_csv(inputs[0])
+    df2 = pd.read_csv(inputs[1])
 
     # duplicates rows and changes names for commodity where the crosswalk changes
-    commodity_crosswalk = pd.read_csv(f"{datPath}/commodity_crosswalk.csv", index_col = 0)
+    commodity_crosswalk = pd.read_csv(inputs[2], index_col = 0)
     differences = commodity_crosswalk[commodity_crosswalk[f'spam_{year1}'] != commodity_crosswalk[f'spam_{year2}']][[f'spam_{year1}', f'spam_{year2}']].drop_duplicates()
     df1_missing = df1[df1["item_name"].isin(differences[f'spam_{year1}'])].copy()
     df1_missing = df1_missing.merge(differences, left_on="item_name", right_on=f'spam_{year1}', how="left")
@@ -64,6 +76,10 @@ def interpolate_vals(year, spam_years, datPath):
     outpath = os.path.join(datPath, "mapspam_outputs", "interpolated", f"interpolated_results_{year}.csv")
     df_interp.to_csv(outpath, index=False)
 
+    manifest = input_manifest(datPath)
+    manifest.record_artifact(outpath, inputs=inputs)
+    manifest.save()
+
     return outpath
 
 
@@ -87,7 +103,9 @@ def fetch_biodiversity_vals_path(year, datPath):
     else: # use interpolated vals
         file_path = os.path.join(datPath, "mapspam_outputs", "interpolated", f"interpolated_results_{year}.csv")
         
-        if not os.path.exists(file_path):
+        # rebuilt whenever either SPAM year or the crosswalk has changed since it was written
+        inputs = interpolation_inputs(year, spam_years, datPath)
+        if not input_manifest(datPath).is_current(file_path, inputs=inputs):
             interpolate_vals(year, spam_years, datPath)
     
     return file_path, spam_yr
@@ -12,6 +12,8 @@ import os
 import sys
 
 from provenance._get_biodiversity_vals import fetch_biodiversity_vals_path
+from processing.ingest_data import load_fao
+from processing.reference_cache import read_excel_cached
 
 def get_wwf_pbd(datPath):
     file_name = "Planet-Based Diets - Data and Viewer.xlsx"
@@ -19,9 +21,7 @@ def get_wwf_pbd(datPath):
     file_path = f"{datPath}/{file_name}"
     if os.path.exists(file_path):
         
-        with warnings.catch_warnings(): 
-            warnings.simplefilter("ignore")
-            df = pd.read_excel(file_path, sheet_name = sheet_name)
+        df = read_excel_cached(file_path, sheet_name = sheet_name)
         return df
     else:
         sys.exit(f"""Couldn't find {file_name} in {datPath}""")
@@ -50,10 +50,9 @@ def get_impacts(wdf, year, coi, filename, results_dir=Path("./results")):
         .drop(columns=["Item_Code_FAO"]))
 
     # load yield data
-    fao_prod = pd.read_csv(f"{datPath}/Production_Crops_Livestock_E_All_Data_(Normalized).csv", encoding = "latin-1", low_memory=False)
+    fao_prod = load_fao("production", datPath, years=year, elements=5412, columns=["Area_Code", "Item_Code", "Element_Code", "Year", "Value"])
     fao_prod = fao_prod[fao_prod.Year == year]
-    yield_dat = fao_prod[fao_prod["Element Code"] == 5412]
-    yield_dat = yield_dat.rename(columns={"Area Code":"Area_Code", "Item Code":"Item_Code"})
+    yield_dat = fao_prod[fao_prod["Element_Code"] == 5412]
     yield_dat = yield_dat[["Area_Code", "Item_Code", "Value"]]
     
     
@@ -12,14 +12,14 @@ import warnings
 import time
 from pathlib import Path
 
+from processing.reference_cache import read_excel_cached
+
 def main(year, coi_iso, bh, bf, results_dir=Path("./results")):
 
     datPath = "./input_data"
     scenPath = results_dir / str(year) / coi_iso
 
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        country_code_data = pd.read_excel(f"{datPath}/nocsDataExport_20251021-164754.xlsx")
+    country_code_data = read_excel_cached(f"{datPath}/nocsDataExport_20251021-164754.xlsx")
     coi = country_code_data.loc[country_code_data["ISO3"]==coi_iso]["FAOSTAT"].values[0]
 
     grouping = "group_name_v7"
@@ -7,6 +7,9 @@ Created on Fri Dec 12 2025
 import pandas as pd
 import os
 from pathlib import Path
+
+from processing.reference_cache import read_excel_cached
+from processing.trade_matrix_io import open_trade_matrix, trade_matrix_path
     
 
 
@@ -24,30 +27,29 @@ def add_cols(indf, area_codes, item_codes):
     return indf
 
 
-def main(year, country_of_interest, sua, historic="", results_dir=Path("./results")):
+def main(year, country_of_interest, sua, historic="", results_dir=Path("./results"), trade_matrix_format="csv"):
 
     
     datPath = "./input_data"
-    trade_feed = results_dir / str(year) / ".mrio" / "TradeMatrixFeed_import_dry_matter.csv"
-    trade_nofeed = results_dir / str(year) / ".mrio" / "TradeMatrix_import_dry_matter.csv"
+    trade_feed = trade_matrix_path(results_dir, year, "TradeMatrixFeed", fmt=trade_matrix_format)
+    trade_nofeed = trade_matrix_path(results_dir, year, "TradeMatrix", fmt=trade_matrix_format)
 
 
-    import warnings
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        area_codes = pd.read_excel(f"{datPath}/nocsDataExport_20251021-164754.xlsx", engine="openpyxl")  
+    area_codes = read_excel_cached(f"{datPath}/nocsDataExport_20251021-164754.xlsx", engine="openpyxl")  
     item_codes = pd.read_csv(f"{datPath}/SUA_Crops_Livestock_E_ItemCodes.csv", encoding = "latin-1", low_memory=False)
     country_code = area_codes[area_codes["ISO3"] == country_of_interest]["FAOSTAT"].values[0]
     weighing_factors = pd.read_csv(f"{datPath}/weighing_factors.csv", encoding = "latin-1")
 
-    prov_mat_no_feed = pd.read_csv(trade_nofeed)
-    prov_mat_feed = pd.read_csv(trade_feed)
-    animal_codes = prov_mat_feed["Animal_Product_Code"].dropna().unique().tolist()
+    prov_mat_no_feed = open_trade_matrix(trade_nofeed)
+    prov_mat_feed = open_trade_matrix(trade_feed)
+    animal_codes = pd.Series(prov_mat_feed.column("Animal_Product_Code")).dropna().unique().tolist()
     # print(country_code)
 
-    alpha = prov_mat_no_feed[prov_mat_no_feed["Item_Code"].isin(animal_codes)].copy()
-    beta = prov_mat_feed[~prov_mat_feed["Animal_Product_Code"].isna()].copy()
-    gamma = prov_mat_feed[prov_mat_feed["Animal_Product_Code"].isna()].copy()
+    # only the rows needed are selected: animal products of all consumers (for the producer totals)
+    # and the feed of this country and of the countries its animal products come from
+    alpha = prov_mat_no_feed.select(items=animal_codes)
+    gamma = prov_mat_feed.select(consumers=[country_code])
+    gamma = gamma[gamma["Animal_Product_Code"].isna()].copy()
 
     gamma = gamma.drop(columns=["Animal_Product_Code"])
 
@@ -73,8 +75,11 @@ def main(year, country_of_interest, sua, historic="", results_dir=Path("./result
     # alpha2=add_cols(animals_consumed_in_country, area_codes, item_codes)
     # print(alpha2[alpha2.Animal_Product=="Primary"].groupby(["Item"])["Value"].sum())
     
-    animals_consumed_in_country["match_code"] = animals_consumed_in_country["Producer_Country_Code"].astype(str) + "_" + animals_consumed_in_country["Item_Code"].astype(str)
-    beta["match_code"] = beta["Consumer_Country_Code"].astype(str) + "_" + beta["Animal_Product_Code"].astype(str)
+    # codes come back as int or float depending on the format and on missing values, so match on integers
+    animals_consumed_in_country["match_code"] = animals_consumed_in_country["Producer_Country_Code"].astype("int64").astype(str) + "_" + animals_consumed_in_country["Item_Code"].astype("int64").astype(str)
+    beta = prov_mat_feed.select(consumers=animals_consumed_in_country["Producer_Country_Code"].unique())
+    beta = beta[~beta["Animal_Product_Code"].isna()].copy()
+    beta["match_code"] = beta["Consumer_Country_Code"].astype("int64").astype(str) + "_" + beta["Animal_Product_Code"].astype("int64").astype(str)
     feed = beta[beta["match_code"].isin(animals_consumed_in_country["match_code"])]
 
     feed = feed.merge(animals_consumed_in_country[["match_code", "Proportion"]], on="match_code", how="left")
@@ -0,0 +1,59 @@
+"""Regression tests of the MRIO solution cache in the trade stage (run with python -m pytest tests)"""
+
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from processing.calculate_trade_matrix import mrio_model
+from processing.mrio_cache import MrioCache
+
+
+def _item_data():
+    trade = pd.DataFrame({
+        "Consumer_Country_Code": [1, 2, 3, 3],
+        "Producer_Country_Code": [2, 3, 1, 2],
+        "Value_Sum": [10.0, 5.0, 20.0, 7.5],
+    })
+    production = pd.DataFrame({"Area_Code": [1, 2, 3], "Value": [100.0, 50.0, 30.0]})
+    return trade, production
+
+
+def test_identical_years_with_cache(tmp_path):
+    # the second year reuses the first year's solve, which must not touch the cache
+    cache = MrioCache(tmp_path)
+    previous_solve = {}
+    trade, production = _item_data()
+    first = mrio_model(15, 2019, trade, production, previous_solve=previous_solve, cache=cache)
+    second = mrio_model(15, 2020, trade, production, previous_solve=previous_solve, cache=cache)
+    pd.testing.assert_frame_equal(first.drop(columns="Year"), second.drop(columns="Year"))
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert cache.stats()["entries"] == 1
+
+
+def test_cache_hit(tmp_path):
+    trade, production = _item_data()
+    first = mrio_model(15, 2019, trade, production, cache=MrioCache(tmp_path))
+    cache = MrioCache(tmp_path)
+    solver_log = []
+    second = mrio_model(15, 2019, trade, production, solver_log=solver_log, cache=cache)
+    pd.testing.assert_frame_equal(first, second)
+    assert cache.hits == 1
+    assert solver_log[0]["path"] == "cache"
+
+
+@pytest.mark.parametrize("contents", [b"", b"not a zip file", b"PK\x03\x04 truncated"])
+def test_corrupt_entry(tmp_path, contents):
+    trade, production = _item_data()
+    cache = MrioCache(tmp_path)
+    expected = mrio_model(15, 2019, trade, production, cache=cache)
+    (entry,) = tmp_path.glob("*.npz")
+    entry.write_bytes(contents)
+    assert cache.get(entry.stem) is None
+    assert not entry.exists()
+    # solved again and stored again
+    pd.testing.assert_frame_equal(mrio_model(15, 2019, trade, production, cache=cache), expected)
+    assert entry.exists()